@@ -18,6 +18,7 @@ from IPython.display import display
 from scipy.stats import multivariate_normal
 import numpy as np
 from functools import partial
+from multiprocessing.pool import ThreadPool
 import scipy as sp
 import math
 import os
@@ -79,6 +80,42 @@ def info_gain(time, xvals, robot_model, param=None):
     #assert(entropy_after - entropy_before - entropy_const > 0)
     return entropy_total - entropy_const
 
+def info_gain_bounds(time, paths, robot_model):
+    ''' Compute upper bounds of the information gain, as computed by info_gain, of each of several sets of potential
+    sample locations, e.g. the points of candidate paths. The gain of each point is only conditioned on the previous
+    point of its set, which by submodularity overestimates its gain given all previous points of the set.'''
+    data = np.vstack([np.array(path) for path in paths])
+    x1 = data[:,0]
+    x2 = data[:,1]
+
+    if robot_model.dimension == 2:
+        queries = np.vstack([x1, x2]).T   
+    elif robot_model.dimension == 3:
+        queries = np.vstack([x1, x2, time * np.ones(len(x1))]).T   
+    xobs = robot_model.xvals
+
+    # Diagonal and first off-diagonal of the matrix of info_gain, conditioned on the previous observations
+    diag = 1.0 + robot_model.variance * robot_model.kern.Kdiag(queries)
+    off = robot_model.variance * np.diag(robot_model.kern.K(queries[1:], queries[:-1]))
+    if xobs is None:
+        scale = 0.5
+    else:
+        scale = 2 * np.pi * np.e
+        A = np.eye(xobs.shape[0]) + robot_model.variance * robot_model.kern.K(xobs)
+        Kx = robot_model.kern.K(xobs, queries)
+        W = np.linalg.solve(A, Kx)
+        diag -= robot_model.variance ** 2 * np.sum(Kx * W, 0)
+        off -= robot_model.variance ** 2 * np.sum(Kx[:, 1:] * W[:, :-1], 0)
+
+    gains = np.log(diag)
+    chained = np.log(diag[1:] - off ** 2 / diag[:-1])
+    starts = np.cumsum([len(path) for path in paths])[:-1]
+    first = np.zeros(len(diag), dtype = bool)
+    first[0] = True
+    first[starts] = True
+    gains[1:] = np.where(first[1:], gains[1:], chained)
+    return scale * np.array([np.sum(part) for part in np.split(gains, starts)])
+
 def mean_UCB(time, xvals, robot_model, param=None, FVECTOR = False):
     ''' Computes the UCB for a set of points along a trajectory '''
     data = np.array(xvals)
@@ -138,8 +175,55 @@ def hotspot_info_UCB(time, xvals, robot_model, param=None):
 def general_target(x, robot_model, nFeatures, W, theta, b):
     return np.dot(theta.T * np.sqrt(2.0 * robot_model.variance / nFeatures), np.cos(np.dot(W, x.T) + b)).T
 
-def sample_max_vals(robot_model, t, nK = 3, nFeatures = 200, visualize = False, obstacles=obslib.FreeWorld(), f_rew='mes'):
-    ''' The mutual information between a potential set of samples and the local maxima'''
+def general_target_gradient(x, robot_model, nFeatures, W, theta, b):
+    d = W.shape[1]
+    return np.dot(theta.T * -np.sqrt(2.0 * robot_model.variance / nFeatures), np.sin(np.dot(W, x.reshape((d, 1))) + b) * W)
+
+def sample_rff_weights(robot_model, nFeatures, d):
+    ''' Draw the random feature weights W and phases b for a spectral approximation of the robot's kernel'''
+    # TODO: make sure this formula is correct
+    if robot_model.dimension == 2:
+        W = np.random.normal(loc = 0.0, scale = np.sqrt(1./(robot_model.lengthscale)), size = (nFeatures, d))
+    elif robot_model.dimension == 3:
+        W = np.random.normal(loc = 0.0, scale = np.sqrt(1./(robot_model.lengthscale[0])), size = (nFeatures, d))
+
+    b = 2 * np.pi * np.random.uniform(low = 0.0, high = 1.0, size = (nFeatures, 1))
+    return W, b
+
+def sample_rff_theta(robot_model, nFeatures, W, b):
+    ''' Draw the coefficients theta of a function sampled from the posterior GP, given the random features (W, b).
+    Raises an exception if the posterior covariance is not positive definite.'''
+    # Compute the features for xx
+    Z = np.sqrt(2 * robot_model.variance / nFeatures) * np.cos(np.dot(W, robot_model.xvals.T) + b)
+
+    # Draw the coefficient theta
+    noise = np.random.normal(loc = 0.0, scale = 1.0, size = (nFeatures, 1))
+
+    # TODO: Figure this code out
+    if robot_model.xvals.shape[0] < nFeatures:
+        #We adopt the formula $theta \sim \N(Z(Z'Z + \sigma^2 I)^{-1} y, I-Z(Z'Z + \sigma^2 I)Z')$.            
+        Sigma = np.dot(Z.T, Z) + robot_model.noise * np.eye(robot_model.xvals.shape[0])
+        mu = np.dot(np.dot(Z, np.linalg.inv(Sigma)), robot_model.zvals)
+        [D, U] = np.linalg.eig(Sigma)
+        U = np.real(U)
+        D = np.real(np.reshape(D, (D.shape[0], 1)))
+
+        R = np.reciprocal((np.sqrt(D) * (np.sqrt(D) + np.sqrt(robot_model.noise))))
+        theta = noise - np.dot(Z, np.dot(U, R*(np.dot(U.T, np.dot(Z.T, noise))))) + mu
+    else:
+        # $theta \sim \N((ZZ'/\sigma^2 + I)^{-1} Z y / \sigma^2, (ZZ'/\sigma^2 + I)^{-1})$.            
+        Sigma = np.dot(Z, Z.T) / robot_model.noise + np.eye(nFeatures)
+        Sigma = np.linalg.inv(Sigma)
+        mu = np.dot(np.dot(Sigma, Z), robot_model.zvals) / robot_model.noise
+        theta = mu + np.dot(np.linalg.cholesky(Sigma), noise)            
+    return theta
+
+def sample_max_vals(robot_model, t, nK = 3, nFeatures = 200, visualize = False, obstacles=obslib.FreeWorld(), f_rew='mes', n_starts = 10, n_workers = None):
+    ''' The mutual information between a potential set of samples and the local maxima
+    Inputs:
+        n_starts (int) the number of top candidates from which each sampled function is locally maximized
+        n_workers (int) the size of the thread pool the local maximizations are spread across; if None, they run serially
+    '''
     # If the robot has not samples yet, return a constant value
     if robot_model.xvals is None:
         return None, None, None
@@ -148,122 +232,56 @@ def sample_max_vals(robot_model, t, nK = 3, nFeatures = 200, visualize = False,
 
     ''' Sample Maximum values i.e. return sampled max values for the posterior GP, conditioned on 
     current observations. Construct random freatures and optimize functions drawn from posterior GP.'''
-    samples = np.zeros((nK, 1))
-    locs = np.zeros((nK, d))
-    funcs = []
-    delete_locs = []
-
+    # Draw all of the function samples up front, so that the random number stream is independent of the pool
+    targets = {}
     for i in xrange(nK):
-        print "Starting global optimization", i, "of", nK
-        logger.info("Starting global optimization {} of {}".format(i, nK))
+        W, b = sample_rff_weights(robot_model, nFeatures, d)
+        try:
+            theta = sample_rff_theta(robot_model, nFeatures, W, b)
+        except:
+            # If Sigma is not positive definite, ignore this simulation
+            print "[ERROR]: Sigma is not positive definite, ignoring simulation", i
+            logger.warning("[ERROR]: Sigma is not positive definite, ignoring simulation {}".format(i))
+            continue
 
-        # Draw the weights for the random features
-        # TODO: make sure this formula is correct
-        if robot_model.dimension == 2:
-            W = np.random.normal(loc = 0.0, scale = np.sqrt(1./(robot_model.lengthscale)), size = (nFeatures, d))
-        elif robot_model.dimension == 3:
-            W = np.random.normal(loc = 0.0, scale = np.sqrt(1./(robot_model.lengthscale[0])), size = (nFeatures, d))
+        # Obtain a function samples from posterior GP
+        target = partial(general_target, robot_model=robot_model, nFeatures=nFeatures, theta=theta, W=W, b=b)
+        target_gradient = partial(general_target_gradient, robot_model=robot_model, nFeatures=nFeatures, theta=theta, W=W, b=b)
+        targets[i] = (target, target_gradient)
 
-        b = 2 * np.pi * np.random.uniform(low = 0.0, high = 1.0, size = (nFeatures, 1))
-        
-        # Compute the features for xx
+    # The candidate set is shared between all of the sampled functions
+    bounds, candidates = maximization_candidates(robot_model.ranges, robot_model.xvals, obstacles, time = t)
 
-        Z = np.sqrt(2 * robot_model.variance / nFeatures) * np.cos(np.dot(W, robot_model.xvals.T) + b)
-        
-        # Draw the coefficient theta
-        noise = np.random.normal(loc = 0.0, scale = 1.0, size = (nFeatures, 1))
+    print "Starting global optimization of", nK, "samples"
+    logger.info("Starting global optimization of {} samples".format(nK))
+    results = multistart_maximization(targets, candidates, bounds, obstacles, n_starts = n_starts, n_workers = n_workers)
 
-        # TODO: Figure this code out
-        if robot_model.xvals.shape[0] < nFeatures:
-            #We adopt the formula $theta \sim \N(Z(Z'Z + \sigma^2 I)^{-1} y, I-Z(Z'Z + \sigma^2 I)Z')$.            
-            try:
-                Sigma = np.dot(Z.T, Z) + robot_model.noise * np.eye(robot_model.xvals.shape[0])
-                mu = np.dot(np.dot(Z, np.linalg.inv(Sigma)), robot_model.zvals)
-                [D, U] = np.linalg.eig(Sigma)
-                U = np.real(U)
-                D = np.real(np.reshape(D, (D.shape[0], 1)))
-
-                R = np.reciprocal((np.sqrt(D) * (np.sqrt(D) + np.sqrt(robot_model.noise))))
-                theta = noise - np.dot(Z, np.dot(U, R*(np.dot(U.T, np.dot(Z.T, noise))))) + mu
-            except:
-                # If Sigma is not positive definite, ignore this simulation
-                print "[ERROR]: Sigma is not positive definite, ignoring simulation", i
-                logger.warning("[ERROR]: Sigma is not positive definite, ignoring simulation {}".format(i))
-                delete_locs.append(i)
-                continue
-        else:
-            # $theta \sim \N((ZZ'/\sigma^2 + I)^{-1} Z y / \sigma^2, (ZZ'/\sigma^2 + I)^{-1})$.            
-            try:
-                Sigma = np.dot(Z, Z.T) / robot_model.noise + np.eye(nFeatures)
-                Sigma = np.linalg.inv(Sigma)
-                mu = np.dot(np.dot(Sigma, Z), robot_model.zvals) / robot_model.noise
-                theta = mu + np.dot(np.linalg.cholesky(Sigma), noise)            
-            except:
-                # If Sigma is not positive definite, ignore this simulation
-                print "[ERROR]: Sigma is not positive definite, ignoring simulation", i
-                logger.warning("[ERROR]: Sigma is not positive definite, ignoring simulation {}".format(i))
-                delete_locs.append(i)
-                continue
+    return collect_max_vals(robot_model, t, nK, targets, results, visualize, f_rew)
 
-            #theta = np.random.multivariate_normal(mean = np.reshape(mu, (nFeatures,)), cov = Sigma, size = (nFeatures, 1))
-            
-        # Obtain a function samples from posterior GP
-        #def target(x): 
-        #    pdb.set_trace()
-        #    return np.dot(theta.T * np.sqrt(2.0 * robot_model.variance / nFeatures), np.cos(np.dot(W, x.T) + b)).T
-        # target = lambda x: np.dot(theta.T * np.sqrt(2.0 * robot_model.variance / nFeatures), np.cos(np.dot(W, x.T) + b)).T
-        # def target(x, W=W, theta=theta):
-        #     W = copy.deepcopy(W)
-        #     theta = copy.deepcopy(theta)
-        #     return np.dot(theta.T * np.sqrt(2.0 * robot_model.variance / nFeatures), np.cos(np.dot(W, x.T) + b)).T
-        # target = lambda x: np.dot(theta.T * np.sqrt(2.0 * robot_model.variance / nFeatures), np.cos(np.dot(W, x.T) + b)).T
-        target = partial(general_target, robot_model=robot_model, nFeatures=nFeatures, theta=theta, W=W, b=b)
-        target_vector_n = lambda x: -target(x.reshape(1, d))
-        
-        # Can only take a 1D input
-        #def target_gradient(x): 
-        #    return np.dot(theta.T * -np.sqrt(2.0 * robot_model.variance / nFeatures), np.sin(np.dot(W, x.reshape((2,1))) + b) * W)
-        target_gradient = lambda x: np.dot(theta.T * -np.sqrt(2.0 * robot_model.variance / nFeatures), np.sin(np.dot(W, x.reshape((d, 1))) + b) * W)
-        target_vector_gradient_n = lambda x: -np.asarray(target_gradient(x).reshape(d,))
-                                                                    
-        # Optimize the function
-        status = False
-        count = 0
-        # Retry optimization up to 5 times; if hasn't converged, give up on this simulated world
-        while status == False and count < 5:
-            maxima, max_val, max_inv_hess, status = global_maximization(target,
-                                                                        target_vector_n,
-                                                                        target_gradient, 
-                                                                        target_vector_gradient_n,
-                                                                        robot_model.ranges,
-                                                                        robot_model.xvals, 
-                                                                        visualize, 
-                                                                        't' + str(t) + '.nK' + str(i),
-                                                                        obstacles,
-                                                                        f_rew=f_rew,
-                                                                        time=t)
-            count += 1
-        if status == False:
+def collect_max_vals(robot_model, t, nK, targets, results, visualize, f_rew):
+    ''' Gather the maxima of the nK sampled functions into the (max values, max locations, functions) returned by sample_max_vals.
+    Samples whose maximization failed are dropped; if all of them failed, the max value observed so far is returned.'''
+    d = robot_model.xvals.shape[1]
+    samples = np.zeros((nK, 1))
+    locs = np.zeros((nK, d))
+    funcs = []
+    delete_locs = []
+
+    for i in xrange(nK):
+        if i not in results or results[i] is None:
             delete_locs.append(i)
             continue
-        
+        maxima, max_val = results[i]
+        target = targets[i][0]
+
         samples[i] = np.array(max_val).reshape((1,1))
         funcs.append(copy.deepcopy(target))
         print "Max Value in Optimization \t \t", samples[i]
         logger.info("Max Value in Optimization \t {}".format(samples[i]))
         locs[i, :] = maxima.reshape((1,d))
-        
-        #if max_val < np.max(robot_model.zvals) + 5.0 * np.sqrt(robot_model.noise) or \
-        #    maxima[0] == robot_model.ranges[0] or maxima[0] == robot_model.ranges[1] or \
-        #    maxima[1] == robot_model.ranges[2] or maxima[1] == robot_model.ranges[3]:
 
-        '''
-        if max_val < np.max(robot_model.zvals) + 5.0 * np.sqrt(robot_model.noise):
-            samples[i] = np.max(robot_model.zvals) + 5.0 * np.sqrt(robot_model.noise)
-            print "Max observed is bigger than max in opt:", samples[i]
-            logger.info("Max observed is bigger than max in opt: {}".format(samples[i]))
-            locs[i, :] = robot_model.xvals[np.argmax(robot_model.zvals)]
-        '''
+        if visualize:
+            visualize_maximization(target, robot_model.ranges, robot_model.xvals, maxima, 't' + str(t) + '.nK' + str(i), f_rew, time = t)
 
     print "Deleting values at:", delete_locs
     samples = np.delete(samples, delete_locs, axis = 0)
@@ -271,6 +289,8 @@ def sample_max_vals(robot_model, t, nK = 3, nFeatures = 200, visualize = False,
 
     # If all global optimizations fail, just return the max value seen so far
     if len(delete_locs) == nK:
+        samples = np.zeros((1, 1))
+        locs = np.zeros((1, d))
         samples[0] = np.max(robot_model.zvals) + 5.0 * np.sqrt(robot_model.noise)
         locs[0, :] = robot_model.xvals[np.argmax(robot_model.zvals)]
   
@@ -278,6 +298,142 @@ def sample_max_vals(robot_model, t, nK = 3, nFeatures = 200, visualize = False,
     print "Returning:", samples.shape, locs.shape
     return samples, locs, funcs
 
+class MaxValueSampler(object):
+    ''' Samples max-values of the posterior GP incrementally across planning steps. The random features and standard
+    normal draws of each sampled function are kept between calls, so only the newly observed data is folded into the
+    feature-space posterior of theta, and every function is re-maximized starting from its previous maxima. A fresh
+    multi-start search is run only for the functions whose maxima moved further than max_shift.'''
+
+    def __init__(self, nK = 3, nFeatures = 200, obstacles = obslib.FreeWorld(), f_rew = 'mes', max_shift = 1.0, n_starts = 10, n_workers = None):
+        '''
+        Inputs:
+            nK (int) the number of functions sampled from the posterior GP
+            nFeatures (int) the number of random features used to approximate each function
+            obstacles (obstacle world) maxima inside of obstacles are ignored
+            f_rew (string) the name of the reward function, used for visualization
+            max_shift (float) the distance a warm-started maxima may move before a fresh search is run
+            n_starts (int) the number of starts of a fresh multi-start search
+            n_workers (int) the size of the thread pool used for the local maximizations; if None, they run serially
+        '''
+        self.nK = nK
+        self.nFeatures = nFeatures
+        self.obstacles = obstacles
+        self.f_rew = f_rew
+        self.max_shift = max_shift
+        self.n_starts = n_starts
+        self.n_workers = n_workers
+        self.reset()
+
+    def reset(self):
+        ''' Forget all of the sampled functions; the next call to sample draws new ones'''
+        self.W = None
+        self.b = None
+        self.noise = None
+        self.precision = None
+        self.weighted_obs = None
+        self.locs = None
+        self.ndata = 0
+        self.kernel = None
+
+    def update_features(self, robot_model):
+        ''' Fold the data observed since the last call into the feature-space posterior of every sampled function.
+        With A = ZZ'/sigma^2 + I and Zy/sigma^2 kept per function, new observations are a rank update of both.'''
+        d = robot_model.xvals.shape[1]
+        kernel = (np.array(robot_model.lengthscale, dtype = float).ravel().tolist(), float(robot_model.variance), float(robot_model.noise))
+
+        # Redraw the features if the kernel was retrained or the robot's dataset was replaced
+        if self.W is None or kernel != self.kernel or robot_model.xvals.shape[0] < self.ndata:
+            self.W = []
+            self.b = []
+            self.noise = []
+            for i in xrange(self.nK):
+                W, b = sample_rff_weights(robot_model, self.nFeatures, d)
+                self.W.append(W)
+                self.b.append(b)
+                self.noise.append(np.random.normal(loc = 0.0, scale = 1.0, size = (self.nFeatures, 1)))
+            self.precision = [np.eye(self.nFeatures) for i in xrange(self.nK)]
+            self.weighted_obs = [np.zeros((self.nFeatures, 1)) for i in xrange(self.nK)]
+            self.locs = [None for i in xrange(self.nK)]
+            self.ndata = 0
+            self.kernel = kernel
+
+        xnew = robot_model.xvals[self.ndata:, :]
+        znew = robot_model.zvals[self.ndata:, :]
+        if xnew.shape[0] > 0:
+            for i in xrange(self.nK):
+                Z = np.sqrt(2 * robot_model.variance / self.nFeatures) * np.cos(np.dot(self.W[i], xnew.T) + self.b[i])
+                self.precision[i] += np.dot(Z, Z.T) / robot_model.noise
+                self.weighted_obs[i] += np.dot(Z, znew) / robot_model.noise
+        self.ndata = robot_model.xvals.shape[0]
+
+    def theta(self, i):
+        ''' $theta \sim \N(A^{-1} Z y / \sigma^2, A^{-1})$, drawn with the stored standard normal noise of function i'''
+        L = np.linalg.cholesky(self.precision[i])
+        mu = np.linalg.solve(self.precision[i], self.weighted_obs[i])
+        return mu + np.linalg.solve(L.T, self.noise[i])
+
+    def sample(self, robot_model, t, visualize = False):
+        ''' Drop-in replacement for sample_max_vals; returns the (max values, max locations, functions) of the posterior GP'''
+        # If the robot has not samples yet, return a constant value
+        if robot_model.xvals is None:
+            return None, None, None
+
+        d = robot_model.xvals.shape[1]
+        self.update_features(robot_model)
+
+        targets = {}
+        for i in xrange(self.nK):
+            try:
+                theta = self.theta(i)
+            except np.linalg.LinAlgError:
+                print "[ERROR]: Sigma is not positive definite, ignoring simulation", i
+                logger.warning("[ERROR]: Sigma is not positive definite, ignoring simulation {}".format(i))
+                continue
+            target = partial(general_target, robot_model=robot_model, nFeatures=self.nFeatures, theta=theta, W=self.W[i], b=self.b[i])
+            target_gradient = partial(general_target_gradient, robot_model=robot_model, nFeatures=self.nFeatures, theta=theta, W=self.W[i], b=self.b[i])
+            targets[i] = (target, target_gradient)
+
+        bounds, candidates = maximization_candidates(robot_model.ranges, robot_model.xvals, self.obstacles, time = t)
+
+        # Re-maximize each function from its previous maxima
+        jobs = []
+        owners = []
+        fresh = {}
+        for i in targets.keys():
+            if self.locs[i] is None:
+                fresh[i] = targets[i]
+                continue
+            start = np.array(self.locs[i], dtype = float)
+            if d == 3:
+                start[2] = t
+            start = np.clip(start, [bound[0] for bound in bounds], [bound[1] for bound in bounds])
+            jobs.append((targets[i][0], targets[i][1], start, bounds))
+            owners.append(i)
+
+        maxima = worker_map(local_maximization, jobs, self.n_workers)
+
+        results = {}
+        for i, (x, val, status) in zip(owners, maxima):
+            shift = np.linalg.norm(x[0:2] - self.locs[i][0:2])
+            if status == False or shift > self.max_shift or self.obstacles.in_obstacle((x[0], x[1]), buff = 0.0):
+                fresh[i] = targets[i]
+            else:
+                results[i] = (x, val)
+
+        # Fall back to a fresh search for functions whose maxima moved too far
+        if len(fresh) > 0:
+            print "Starting global optimization of", len(fresh), "of", self.nK, "samples"
+            logger.info("Starting global optimization of {} of {} samples".format(len(fresh), self.nK))
+            results.update(multistart_maximization(fresh, candidates, bounds, self.obstacles, n_starts = self.n_starts, n_workers = self.n_workers))
+
+        for i in xrange(self.nK):
+            if i in results and results[i] is not None:
+                self.locs[i] = results[i][0]
+            else:
+                self.locs[i] = None
+
+        return collect_max_vals(robot_model, t, self.nK, targets, results, visualize, self.f_rew)
+
 def mves(time, xvals, robot_model, param, FVECTOR = False):
     ''' Define the Acquisition Function and the Gradient of MES'''
     # Compute the aquisition function value f and garident g at the queried point x using MES, given samples
@@ -317,7 +473,9 @@ def mves(time, xvals, robot_model, param, FVECTOR = False):
         pdfgamma = sp.stats.norm.pdf(gamma)
         cdfgamma = sp.stats.norm.cdf(gamma)
         utility = gamma * pdfgamma / (2.0 * cdfgamma) - np.log(cdfgamma)
-        
+        # The MES utility is scaled by 2 to keep the historical magnitude of the reward
+        utility = 2.0 * utility
+
         if FVECTOR:
             f += utility
         else:
@@ -325,8 +483,6 @@ def mves(time, xvals, robot_model, param, FVECTOR = False):
 
         #if np.sum(utility) == 0.000:
         #    pdb.set_trace()
-
-        f += sum(utility)
     # Average f
     f = f / maxes.shape[0]
     # f is an np array; return scalar value
@@ -336,6 +492,74 @@ def mves(time, xvals, robot_model, param, FVECTOR = False):
         # f is an np array; return scalar value
         return f[0]
 
+def maximal_set_ball(max_locs, dimension, time, radius = 2.0, radius_steps = 10, angle_steps = 10):
+    ''' The set of points on concentric rings of up to radius around each sampled maxima, plus the maxima itself.
+    Returns an (nK * nball) x dimension array, ordered by maxima, and nball.'''
+    rings = np.linspace(0., radius, radius_steps)[1:]
+    angles = np.linspace(0., 2. * np.pi, angle_steps, endpoint = False)
+    dist, angle = np.meshgrid(rings, angles, indexing = 'ij')
+    offsets = np.vstack([np.zeros((1, 2)), np.vstack([(dist * np.cos(angle)).ravel(), (dist * np.sin(angle)).ravel()]).T])
+    nball = offsets.shape[0]
+
+    ball = np.vstack([np.reshape(loc[0:2], (1, 2)) + offsets for loc in max_locs])
+    if dimension == 3:
+        ball = np.hstack([ball, time * np.ones((ball.shape[0], 1))])
+    return ball, nball
+
+def mves_maximal_set(time, xvals, robot_model, param, FVECTOR = False):
+    ''' Define the Acquisition Function for maximal-set information gain, where param is the tuple (max values, max locations, functions).
+    The utility of a query point is the reduction of its entropy once the belief is conditioned on a ball of observations
+    around each sampled maxima. The conditioning only changes the variance, so all of the maxima are scored from one
+    prediction of the queries and the posterior covariance between the queries and the balls.'''
+    max_vals = param[0]
+    max_locs = param[1]
+    # If no max values are provided, return default value
+    if max_vals is None:
+        if FVECTOR:
+            return np.ones((xvals.shape[0], 1))
+        else:
+            return 1.0
+
+    data = np.array(xvals)
+    x1 = data[:,0]
+    x2 = data[:,1]
+    if robot_model.dimension == 2:
+        queries = np.vstack([x1, x2]).T   
+    elif robot_model.dimension == 3:
+        queries = np.vstack([x1, x2, time * np.ones(len(x1))]).T   
+
+    ball, nball = maximal_set_ball(max_locs, robot_model.dimension, time)
+
+    # Posterior covariance between the queries and the balls, and within the balls
+    mean, var_before = robot_model.predict_value(queries)
+    cross = robot_model.kern.K(queries, ball)
+    ball_cov = robot_model.kern.K(ball)
+    if robot_model.xvals is not None:
+        Kxq = robot_model.kern.K(robot_model.xvals, queries)
+        Kxb = robot_model.kern.K(robot_model.xvals, ball)
+        WKxb = np.dot(robot_model.woodbury_inv, Kxb)
+        cross -= np.dot(Kxq.T, WKxb)
+        ball_cov -= np.dot(Kxb.T, WKxb)
+
+    f = np.zeros((queries.shape[0], 1))
+    for i in xrange(max_locs.shape[0]):
+        index = slice(i * nball, (i + 1) * nball)
+        C = cross[:, index]
+        S = ball_cov[index, index] + robot_model.noise * np.eye(nball)
+
+        # Variance of the queries after conditioning on the ball around maxima i
+        var_after = var_before - np.sum(C * np.linalg.solve(S, C.T).T, axis = 1).reshape(-1, 1)
+        var_after = np.maximum(var_after, robot_model.noise)
+        f += entropy_of_n(var_before) - entropy_of_n(var_after)
+
+    # Average f
+    f = f / max_locs.shape[0]
+    if FVECTOR:
+        return f
+    else:
+        # f is an np array; return scalar value
+        return np.sum(f)
+
 def naive(time, xvals, robot_model, param, FVECTOR = False):
     ''' The naive reward function for the MSS problem where param is number of samples to draw and range for reward'''
 
@@ -413,6 +637,51 @@ def naive_value(time, xvals, robot_model, param, FVECTOR = False):
         return np.sum(f)
 
     
+
+class AcquisitionRaster(object):
+    ''' A raster of an additive aquisition function, i.e. one whose value on a path is the sum of its value at each 
+    point of the path, evaluated once under a fixed belief. The reward of a path is then computed by bilinear lookups 
+    into the raster instead of a GP prediction. Instances have the same call signature as the aquisition functions.'''
+
+    def __init__(self, aquisition_function, time, robot_model, param = None, resolution = 100):
+        '''
+        Inputs:
+            aquisition_function (function) an additive aquisition function supporting FVECTOR
+            time (int) the current timestep of planning
+            robot_model (GPModel) the belief under which the raster is evaluated
+            param (mixed) the parameter of the aquisition function
+            resolution (int) the number of raster cells along each dimension of the world
+        '''
+        self.ranges = robot_model.ranges
+        self.resolution = resolution
+
+        x1vals = np.linspace(self.ranges[0], self.ranges[1], resolution)
+        x2vals = np.linspace(self.ranges[2], self.ranges[3], resolution)
+        x1, x2 = np.meshgrid(x1vals, x2vals, sparse = False, indexing = 'xy') 
+        data = np.vstack([x1.ravel(), x2.ravel()]).T
+        self.values = aquisition_function(time = time, xvals = data, robot_model = robot_model, param = param, FVECTOR = True).reshape(x1.shape)
+
+    def __call__(self, time, xvals, robot_model = None, param = None, FVECTOR = False):
+        ''' Look up the aquisition function at a set of points; time, robot_model and param are fixed by the raster'''
+        data = np.array(xvals)
+        n = self.resolution
+
+        # Fractional cell coordinates of each point, clamped to the raster
+        fx = (data[:, 0] - self.ranges[0]) / (self.ranges[1] - self.ranges[0]) * (n - 1)
+        fy = (data[:, 1] - self.ranges[2]) / (self.ranges[3] - self.ranges[2]) * (n - 1)
+        ix = np.clip(np.floor(fx).astype(int), 0, n - 2)
+        iy = np.clip(np.floor(fy).astype(int), 0, n - 2)
+        wx = np.clip(fx - ix, 0.0, 1.0)
+        wy = np.clip(fy - iy, 0.0, 1.0)
+
+        f = (1. - wx) * (1. - wy) * self.values[iy, ix] + wx * (1. - wy) * self.values[iy, ix + 1] + \
+            (1. - wx) * wy * self.values[iy + 1, ix] + wx * wy * self.values[iy + 1, ix + 1]
+
+        if FVECTOR:
+            return f.reshape(-1, 1)
+        else:
+            return np.sum(f)
+
 def entropy_of_n(var):    
     return np.log(np.sqrt(2.0 * np.pi * var))
 
@@ -506,23 +775,6 @@ def global_maximization(target, target_vector_n, target_grad, target_vector_grad
     #     start = np.asarray(Xgrid_exception[max_index, :])
 
     
-    if visualize:
-        # Generate a set of observations from robot model with which to make contour plots
-        x1vals = np.linspace(hold_ranges[0], hold_ranges[1], 100)
-        x2vals = np.linspace(hold_ranges[2], hold_ranges[3], 100)
-        x1, x2 = np.meshgrid(x1vals, x2vals, sparse = False, indexing = 'xy') # dimension: NUM_PTS x NUM_PTS       
-        if dim == 2: 
-            data = np.vstack([x1.ravel(), x2.ravel()]).T
-        elif dim == 3:
-            data = np.vstack([x1.ravel(), x2.ravel(), time * np.ones(len(x1.ravel()))]).T
-
-        observations = target(data)
-        fig2, ax2 = plt.subplots(figsize=(8, 8))
-        ax2.set_xlim(hold_ranges[0:2])
-        ax2.set_ylim(hold_ranges[2:])        
-        ax2.set_title('Countour Plot of the Approximated World Model')     
-        plot = ax2.contourf(x1, x2, observations.reshape(x1.shape), 25, cmap = 'viridis')
-
     if dim == 2:
         res = sp.optimize.minimize(fun = target_vector_n, x0 = start, method = 'SLSQP', \
                 jac = target_vector_gradient_n, bounds = ((ranges[0], ranges[1]), (ranges[2], ranges[3])))
@@ -538,20 +790,170 @@ def global_maximization(target, target_vector_n, target_grad, target_vector_grad
         return 0, 0, 0, False
     
     if visualize:
-        # Generate a set of observations from robot model with which to make contour plots
-        scatter = ax2.scatter(guesses[:, 0], guesses[:, 1], color = 'k', s = 20.0)
-        scatter = ax2.scatter(res['x'][0], res['x'][1], marker = '*', color = 'r', s = 500)      
-
-        if not os.path.exists('./figures/'+str(f_rew)+'/opt'):
-            os.makedirs('./figures/'+str(f_rew)+'/opt')
-        fig2.savefig('./figures/'+str(f_rew)+'/opt/globalopt.' + str(filename) + '.png')
-        # plt.show()
-        plt.close()
-        plt.close('all')
+        visualize_maximization(target, hold_ranges, guesses, res['x'], filename, f_rew, time = time)
 
     # print res
     return res['x'], -res['fun'], res['jac'], True
 
+def halton_sequence(n_points, dim):
+    ''' The first n_points of the Halton low-discrepancy sequence in the unit hypercube of dimension dim'''
+    primes = [2, 3, 5, 7, 11, 13]
+    sequence = np.zeros((n_points, dim))
+    for d in xrange(dim):
+        base = primes[d]
+        # Skip the first element of the sequence, which is always the origin
+        index = np.arange(1, n_points + 1)
+        scale = 1.0
+        while np.any(index > 0):
+            scale /= base
+            sequence[:, d] += scale * (index % base)
+            index = index // base
+    return sequence
+
+# Candidate sets are built once per mission; maps (id(obstacles), ranges, n_points) to (obstacles, candidates)
+_candidate_cache = {}
+
+def candidate_set(ranges, obstacles, n_points = 4096):
+    ''' Return a quasi-random set of obstacle-free 2D candidate points over ranges, cached per ranges and obstacle world
+    Input:
+        ranges (tuple of floats) the bounds of the candidate set
+        obstacles (obstacle world) candidates inside of obstacles are removed
+        n_points (int) the number of Halton points drawn before filtering
+    Output:
+        candidates (nparray) a NUM_PTS x 2 read-only array of candidate points
+    '''
+    key = (id(obstacles), tuple(ranges), n_points)
+    if key in _candidate_cache and _candidate_cache[key][0] is obstacles:
+        return _candidate_cache[key][1]
+
+    unit = halton_sequence(n_points, 2)
+    x1 = ranges[0] + unit[:, 0] * (ranges[1] - ranges[0])
+    x2 = ranges[2] + unit[:, 1] * (ranges[3] - ranges[2])
+    candidates = np.vstack([x1, x2]).T
+    candidates = candidates[~obstacles.in_obstacle_batch(candidates, buff = 0.0), :]
+    candidates.flags.writeable = False
+
+    _candidate_cache[key] = (obstacles, candidates)
+    return candidates
+
+def maximization_candidates(ranges, guesses, obstacles, time = None, n_points = 4096):
+    ''' Build the candidate set shared by the global maximization of all sampled functions.
+    Input:
+        ranges (tuple of floats) the bounds of the world
+        guesses (nparray) previously sampled locations, added to the candidates in the 2D case
+        obstacles (obstacle world) candidates inside of obstacles are removed
+        time (float) the time coordinate of the candidates in the 3D case
+        n_points (int) the size of the quasi-random candidate set, before obstacle filtering
+    Output:
+        bounds (tuple of tuples) the buffered optimization bounds for each dimension
+        candidates (nparray) a NUM_PTS x dim array of candidate starting points
+    '''
+    # Create a buffer around the boundary so the optmization doesn't always concentrate there
+    bb = ((ranges[1] - ranges[0])*0.10, (ranges[3] - ranges[2]) * 0.10)
+    ranges = (ranges[0] + bb[0], ranges[1] - bb[0], ranges[2] + bb[1], ranges[3] - bb[1])
+
+    dim = guesses.shape[1]
+    grid = candidate_set(ranges, obstacles, n_points)
+
+    if dim == 2:
+        inside = (guesses[:, 0] >= ranges[0]) & (guesses[:, 0] <= ranges[1]) & (guesses[:, 1] >= ranges[2]) & (guesses[:, 1] <= ranges[3])
+        candidates = np.vstack([grid, guesses[inside, :]])
+        bounds = ((ranges[0], ranges[1]), (ranges[2], ranges[3]))
+    elif dim == 3:
+        candidates = np.hstack([grid, time * np.ones((grid.shape[0], 1))])
+        bounds = ((ranges[0], ranges[1]), (ranges[2], ranges[3]), (time, time))
+
+    return bounds, candidates
+
+def local_maximization(job):
+    ''' Locally maximize a sampled function with L-BFGS-B; job is a tuple (target, target_gradient, start, bounds)'''
+    target, target_gradient, start, bounds = job
+    d = start.shape[0]
+    target_n = lambda x: -float(target(x.reshape(1, d)))
+    target_gradient_n = lambda x: -np.asarray(target_gradient(x)).reshape(d,)
+    res = sp.optimize.minimize(fun = target_n, x0 = start, method = 'L-BFGS-B', jac = target_gradient_n, bounds = bounds)
+    return res['x'], -res['fun'], res['success']
+
+# Thread pools kept between calls of worker_map, by size
+_worker_pools = {}
+
+def worker_map(function, jobs, n_workers = None):
+    ''' Map a function over a list of jobs, serially if n_workers is None, and otherwise in a thread pool of n_workers
+    threads that is created on first use and kept for later calls'''
+    if n_workers is None or n_workers < 2 or len(jobs) < 2:
+        return map(function, jobs)
+    if n_workers not in _worker_pools:
+        _worker_pools[n_workers] = ThreadPool(n_workers)
+    return _worker_pools[n_workers].map(function, jobs)
+
+def multistart_maximization(targets, candidates, bounds, obstacles, n_starts = 10, n_workers = None):
+    ''' Perform global maximization of a set of sampled functions, running L-BFGS-B from the n_starts highest 
+    obstacle-free candidates of each function. The local searches of all functions are spread across n_workers threads.
+    Input:
+        targets (dictionary) maps a sample index to the (function, gradient) pair of that sampled function
+        candidates (nparray) the shared NUM_PTS x dim set of candidate starting points
+        bounds (tuple of tuples) the optimization bounds for each dimension
+        obstacles (obstacle world) starts and maxima inside of obstacles are ignored
+    Output:
+        results (dictionary) maps a sample index to the (location, value) of its best maxima, or None if every local search failed
+    '''
+    keys = targets.keys()
+    values = worker_map(lambda i: targets[i][0](candidates).ravel(), keys, n_workers)
+
+    # Choose the top candidates of each function that are outside of the obstacles
+    free = np.flatnonzero(~obstacles.in_obstacle_batch(candidates, buff = 0.0))
+    jobs = []
+    owners = []
+    for i, y in zip(keys, values):
+        for index in free[np.argsort(-y[free])][:n_starts]:
+            jobs.append((targets[i][0], targets[i][1], candidates[index, :], bounds))
+            owners.append(i)
+
+    maxima = worker_map(local_maximization, jobs, n_workers)
+
+    results = dict((i, None) for i in keys)
+    for i, (x, val, status) in zip(owners, maxima):
+        if status == False or obstacles.in_obstacle((x[0], x[1]), buff = 0.0):
+            continue
+        if results[i] is None or val > results[i][1]:
+            results[i] = (x, val)
+
+    for i in keys:
+        if results[i] is None:
+            print "Failed to converge!"
+            logger.warning("Failed to converge! \n")
+    return results
+
+def visualize_maximization(target, ranges, guesses, maxima, filename, f_rew, time = None):
+    ''' Save a contour plot of a sampled function, the sampled locations, and the maxima found for it'''
+    dim = guesses.shape[1]
+
+    # Generate a set of observations from robot model with which to make contour plots
+    x1vals = np.linspace(ranges[0], ranges[1], 100)
+    x2vals = np.linspace(ranges[2], ranges[3], 100)
+    x1, x2 = np.meshgrid(x1vals, x2vals, sparse = False, indexing = 'xy') # dimension: NUM_PTS x NUM_PTS       
+    if dim == 2: 
+        data = np.vstack([x1.ravel(), x2.ravel()]).T
+    elif dim == 3:
+        data = np.vstack([x1.ravel(), x2.ravel(), time * np.ones(len(x1.ravel()))]).T
+
+    observations = target(data)
+    fig2, ax2 = plt.subplots(figsize=(8, 8))
+    ax2.set_xlim(ranges[0:2])
+    ax2.set_ylim(ranges[2:])        
+    ax2.set_title('Countour Plot of the Approximated World Model')     
+    plot = ax2.contourf(x1, x2, observations.reshape(x1.shape), 25, cmap = 'viridis')
+
+    scatter = ax2.scatter(guesses[:, 0], guesses[:, 1], color = 'k', s = 20.0)
+    scatter = ax2.scatter(maxima[0], maxima[1], marker = '*', color = 'r', s = 500)      
+
+    if not os.path.exists('./figures/'+str(f_rew)+'/opt'):
+        os.makedirs('./figures/'+str(f_rew)+'/opt')
+    fig2.savefig('./figures/'+str(f_rew)+'/opt/globalopt.' + str(filename) + '.png')
+    # plt.show()
+    plt.close()
+    plt.close('all')
+
 
 def exp_improvement(time, xvals, robot_model, param = None):
     ''' The aquisition function using expected information, as defined in Hennig and Schuler Entropy Search'''
@@ -70,6 +70,7 @@ class Evaluation:
                         'distance_traveled': {},
                         'mes_reward_robot': {},
                         'mes_reward_omni': {},
+                        'search_stats': {},
                        }
         for i in range(0,num_stars):
             self.metrics['star_obs_'+str(i)] = {}
@@ -310,6 +311,11 @@ class Evaluation:
 
         self.metrics['distance_traveled'][t] = dist
     
+    def update_search_stats(self, t, stats):
+        ''' Records the statistics of the tree search of a planning step, as returned by SearchStats.as_dict '''
+        self.metrics['search_stats'][t] = stats
+        logger.info("Search statistics at {}: {}".format(t, stats))
+
     def plot_metrics(self):
         ''' Plots the performance metrics computed over the course of a info'''
         # Asumme that all metrics have the same time as MSE; not necessary
@@ -370,6 +376,14 @@ class Evaluation:
             f = open('./figures/'+self.reward_function + '/stars.csv', "a")
             np.savetxt(f, (star_obs[i].T, star_obs_loc_x[i].T, star_obs_loc_y[i].T))
             f.close()
+
+        ''' Save the scalar tree search statistics, one row per planning step, if they were collected '''
+        if len(self.metrics['search_stats']) > 0:
+            steps = sorted(self.metrics['search_stats'].keys())
+            names = sorted(set(chain.from_iterable([self.metrics['search_stats'][k].keys() for k in steps])) - set(['depth_histogram']))
+            np.savetxt('./figures/' + self.reward_function + '/search_stats.csv', \
+                np.array([[k] + [self.metrics['search_stats'][k].get(name, 0) for name in names] for k in steps]), \
+                delimiter = ',', header = ','.join(['time'] + names))
         #np.savetxt('./figures/' + self.reward_function + '/aqu_fun.csv', aqu_fun)
         #np.savetxt('./figures/' + self.reward_function + '/MSE.csv', MSE)
         #np.savetxt('./figures/' + self.reward_function + '/hotspot_MSE.csv', hotspot_error)
@@ -76,9 +76,17 @@ class GPModel(object):
         else:
             raise ValueError('Kernel type must by \'rbf\'')
             
-        # Intitally, before any data is created, 
+        # Intitally, before any data is created,
         self.model = None
 
+    def __copy__(self):
+        ''' Shallow copy of the model; if a search is timing its GP operations, they are rebound to the copy '''
+        gp = self.__class__.__new__(self.__class__)
+        gp.__dict__.update(self.__dict__)
+        if 'search_stats' in gp.__dict__:
+            gp.search_stats.instrument_belief(gp)
+        return gp
+
     def predict_value(self, xvals, include_noise = True):
         ''' Public method returns the mean and variance predictions at a set of input locations.
         Inputs:
@@ -17,17 +17,86 @@ import os
 import GPy as GPy
 import time
 from itertools import chain
+from collections import OrderedDict
 import pdb
 import logging
 logger = logging.getLogger('robot')
 from aq_library import *
 import copy
 import random
+import multiprocessing
+import heapq
+import threading
+import Queue
+import atexit
+
+# Record layout of the tree dumps; every node of a tree is one record, and the node ids are the record indices
+TREE_DTYPE = np.dtype([('parent', np.int32), ('depth', np.int16), ('action', np.int32), ('queries', np.int32),
+                       ('reward', np.float64), ('cost', np.float64)])
+
+def tree_records(tree):
+    '''
+    Converts a tree dictionary, as built by MCTS, to an array of TREE_DTYPE records. The root is node 0 with
+    parent -1 and action -1; all other nodes are ordered by depth, so parents always precede their children.
+    Input: tree (dictionary) node names to node tuples
+    Output: records (array of TREE_DTYPE)
+    '''
+    names = sorted((key for key in tree.keys() if key != 'root'), key = lambda name: name.count('child'))
+    ids = {'root': 0}
+    records = np.zeros(len(names) + 1, dtype = TREE_DTYPE)
+    records[0] = (-1, 0, -1, tree['root'][1], 0.0, 0.0)
+    for i, name in enumerate(names, 1):
+        parent, _, action = name.rpartition(' child ')
+        if parent == '':
+            parent, action = 'root', name.split(' ')[1]
+        samples, path, cost, reward, queries = tree[name]
+        ids[name] = i
+        records[i] = (ids[parent], name.count('child'), int(action), queries, reward, cost)
+    return records
+
+class TreeWriter(object):
+    '''
+    Writes tree dumps to disk from a background thread, so that the planner is not stalled by the disk. The
+    trees are queued as they are and converted to TREE_DTYPE records by the thread; a queued tree must not be
+    modified afterwards. Files are written under a temporary name and renamed, so that a reader never sees a
+    partial dump.
+    '''
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def write(self, tree, filename):
+        ''' Queues the tree to be written to filename, starting the writer thread when needed '''
+        if self.thread is None:
+            self.thread = threading.Thread(target = self.run, name = 'tree-writer')
+            self.thread.daemon = True
+            self.thread.start()
+            atexit.register(self.flush)
+        self.queue.put((tree, filename))
+
+    def flush(self):
+        ''' Blocks until all queued trees are written '''
+        self.queue.join()
+
+    def run(self):
+        while True:
+            tree, filename = self.queue.get()
+            try:
+                temp = filename + '.part'
+                with open(temp, 'wb') as f:
+                    np.save(f, tree_records(tree))
+                os.rename(temp, filename)
+            except Exception as e:
+                logger.warning("Could not write tree dump {}: {}".format(filename, e))
+            finally:
+                self.queue.task_done()
+
+tree_writer = TreeWriter()
 
 class MCTS(object):
     '''Class that establishes a MCTS for nonmyopic planning'''
 
-    def __init__(self, computation_budget, belief, initial_pose, rollout_length, path_generator, aquisition_function, f_rew, T, aq_param = None, use_cost = False, tree_type = None, num_samples=20):
+    def __init__(self, computation_budget, belief, initial_pose, rollout_length, path_generator, aquisition_function, f_rew, T, aq_param = None, use_cost = False, tree_type = None, num_samples=20, deadline = None, min_iterations = 0):
         '''
         Initialize with constraints for the planning, including whether there is a budget or planning horizon
         Inputs:
@@ -40,6 +109,8 @@ class MCTS(object):
             aquisition_function (function) the criteria to make decisions
             f_rew (string) the name of the function used to make decisions
             T (float) time in the global world used for aquisition weighting
+            deadline (float) if provided, the tree is built for this many seconds instead of computation_budget iterations
+            min_iterations (int) number of iterations run in deadline mode even if the deadline has passed
         '''
         # Status of the robot
         self.GP = belief
@@ -49,6 +120,10 @@ class MCTS(object):
         # Parameterization for the search
         self.comp_budget = computation_budget
         self.rl = rollout_length
+        self.deadline = deadline
+        self.min_iterations = min_iterations
+        # Number of iterations achieved by the last call to choose_trajectory
+        self.iterations = 0
 
         # The tree
         self.tree = None
@@ -88,11 +163,11 @@ class MCTS(object):
 
         # randomly sample the world for entropy search function
         if self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
-            self.max_val, self.max_locs, self.target  = sample_max_vals(self.GP, t = t)
+            self.max_val, self.max_locs, self.target  = sample_max_vals(self.GP, t = t, obstacles = self.path_generator.obstacle_world)
             
         time_start = time.time()            
         # while we still have time to compute, generate the tree
-        while i < self.comp_budget:#time.time() - time_start < self.comp_budget:
+        while self.keep_searching(i, time_start):
             i += 1
             current_node = self.tree_policy()
             sequence = self.rollout_policy(current_node)
@@ -100,6 +175,7 @@ class MCTS(object):
             self.update_tree(reward, cost, sequence)
 
         time_end = time.time()
+        self.iterations = i
         print "Rollouts completed in", str(time_end - time_start) +  "s", 
 
         # get the best action to take with most promising futures, base best on whether to
@@ -110,9 +186,22 @@ class MCTS(object):
         #Document the information
         print "Number of rollouts:", i, "\t Size of tree:", len(self.tree)
         logger.info("Number of rollouts: {} \t Size of tree: {}".format(i, len(self.tree)))
-        np.save('./figures/' + self.f_rew + '/tree_' + str(t) + '.npy', self.tree)
+        tree_writer.write(self.tree, './figures/' + self.f_rew + '/tree_' + str(t) + '.npy')
         return self.tree[best_sequence][0], self.tree[best_sequence][1], best_val, paths, all_vals, self.max_locs, self.max_val
 
+    def keep_searching(self, i, time_start):
+        '''
+        Decides whether the tree search should run another iteration. By default the search runs for the
+        computation budget in iterations; in deadline (anytime) mode it runs until the deadline has passed,
+        but for at least min_iterations.
+        Inputs:
+            i (int) number of iterations run so far
+            time_start (float) wall-clock time at which the search started
+        '''
+        if self.deadline is None:
+            return i < self.comp_budget
+        return i < self.min_iterations or time.time() - time_start < self.deadline
+
     def initialize_tree(self):
         '''
         Creates a tree instance, which is a dictionary, that keeps track of the nodes in the world
@@ -136,15 +225,15 @@ class MCTS(object):
             n - number of times that node has been evaluated
             the formula: avg_r + c_p * np.sqrt(2*np.log(N)/n)
         '''
-        leaf_eval = {}
         actions, dense_paths = self.path_generator.get_path_set(self.cp)
-        for i, val in actions.items():
-            node = 'child '+ str(i)
-            if self.tree[node][4] == 0:
-                return node
-            else:
-                leaf_eval[node] = self.tree[node][3] + self.c*np.sqrt(2*(np.log(self.tree['root'][1]))/self.tree[node][4])
-        return random.choice([key for key in leaf_eval.keys() if leaf_eval[key] == max(leaf_eval.values())])
+        nodes = ['child '+ str(i) for i in actions.keys()]
+        rewards = np.array([self.tree[node][3] for node in nodes], dtype = float)
+        queries = np.array([self.tree[node][4] for node in nodes], dtype = float)
+        unvisited = np.flatnonzero(queries == 0)
+        if len(unvisited) > 0:
+            return nodes[unvisited[0]]
+        leaf_eval = rewards + self.c*np.sqrt(2*(np.log(self.tree['root'][1]))/queries)
+        return nodes[random.choice(np.flatnonzero(leaf_eval == leaf_eval.max()))]
 
     def rollout_policy(self, node):
         '''
@@ -274,17 +363,59 @@ class MCTS(object):
         return best_child, best, value
 
 
+class TreeStorage(object):
+    '''
+    Struct-of-arrays storage of the statistics of the nodes of a search tree. Each node is an integer id into
+    growable arrays of parent ids, depths, number of queries and summed rewards, so that the statistics of all
+    children of a node are read with a single indexing operation.
+    '''
+    __slots__ = ['parent', 'depth', 'nqueries', 'reward', 'size']
+
+    def __init__(self, capacity = 1024):
+        self.parent = -np.ones(capacity, dtype = int)
+        self.depth = np.zeros(capacity, dtype = int)
+        self.nqueries = np.zeros(capacity, dtype = int)
+        self.reward = np.zeros(capacity)
+        self.size = 0
+
+    def add(self, parent, depth):
+        ''' Allocates a node with no queries and returns its id; the arrays double in size when full '''
+        if self.size == len(self.nqueries):
+            n = len(self.nqueries)
+            self.parent = np.concatenate([self.parent, -np.ones(n, dtype = int)])
+            self.depth = np.concatenate([self.depth, np.zeros(n, dtype = int)])
+            self.nqueries = np.concatenate([self.nqueries, np.zeros(n, dtype = int)])
+            self.reward = np.concatenate([self.reward, np.zeros(n)])
+
+        i = self.size
+        self.parent[i] = parent
+        self.depth[i] = depth
+        self.nqueries[i] = 0
+        self.reward[i] = 0.0
+        self.size += 1
+        return i
+
 class Node(object):
+    ''' A node of a search tree; its statistics live in the TreeStorage shared by all nodes of the tree '''
+    __slots__ = ['store', 'id', 'label', 'pose', 'zvals', 'parent', 'children', 'child_ids', 'node_type', 'action', 'dense_path', 'cached_reward', 'cached_belief', 'fingerprint', 'edge_zvals']
+
     def __init__(self, pose, parent, name, action = None, dense_path = None, zvals = None):
         self.pose = pose
-        self.name = name
+        # The label of the node relative to its parent; the full name is composed on demand
+        self.label = name
         self.zvals = zvals
-        self.reward = 0.0
-        self.nqueries = 0
         
         # Parent will be none if the node is a root
         self.parent = parent
         self.children = None
+        self.child_ids = None
+        # Memoized immediate reward of an action node and belief of a belief node
+        self.cached_reward = None
+        self.cached_belief = None
+        # Order-independent hash of the observations made since the root, used by transposition tables
+        self.fingerprint = 0
+        # Observations of the belief children shared with other action nodes, keyed by child
+        self.edge_zvals = None
 
         # Set belief or belief action node
         if action is None:
@@ -294,25 +425,103 @@ class Node(object):
 
             # If the root node, depth is 0
             if parent is None:
-                self.depth = 0
+                depth = 0
             else:
-                self.depth = parent.depth + 1
+                depth = parent.depth + 1
         else:
             self.node_type = 'BA'
             self.action = action
             self.dense_path = dense_path
-            self.depth = parent.depth
+            depth = parent.depth
+
+        # A root allocates the storage of its tree
+        if parent is None:
+            self.store = TreeStorage()
+            self.id = self.store.add(-1, depth)
+        else:
+            self.store = parent.store
+            self.id = self.store.add(parent.id, depth)
+
+    @property
+    def name(self):
+        labels = []
+        node = self
+        while node is not None:
+            labels.append(node.label)
+            node = node.parent
+        return '_'.join(reversed(labels))
+
+    @property
+    def nqueries(self):
+        return self.store.nqueries[self.id]
+
+    @nqueries.setter
+    def nqueries(self, value):
+        self.store.nqueries[self.id] = value
+
+    @property
+    def reward(self):
+        return self.store.reward[self.id]
+
+    @reward.setter
+    def reward(self, value):
+        self.store.reward[self.id] = value
+
+    @property
+    def depth(self):
+        return self.store.depth[self.id]
+
+    @depth.setter
+    def depth(self, value):
+        self.store.depth[self.id] = value
 
     def add_children(self, child_node):
         if self.children is None:
             self.children = []
+            self.child_ids = []
         self.children.append(child_node)
+        self.child_ids.append(child_node.id)
+
+    def child_stats(self):
+        ''' Returns the number of queries and the summed rewards of the children as arrays '''
+        return self.store.nqueries[self.child_ids], self.store.reward[self.child_ids]
+
+    def detach(self):
+        '''
+        Makes the node the root of its own tree: its subtree is copied into a new, compact storage and the
+        depths are shifted so that the node is at depth 0. The rest of the old tree is left behind. Memoized
+        rewards and beliefs were computed from the old root belief, so they are dropped. Nodes shared by several
+        parents of a transposition table are copied once.
+        '''
+        offset = self.depth
+        nodes = []
+        store = TreeStorage()
+        stack = [(self, -1)]
+        while len(stack) > 0:
+            node, parent_id = stack.pop()
+            if node.store is store:
+                continue
+            nqueries, reward, depth = node.nqueries, node.reward, node.depth
+            node.store = store
+            node.id = store.add(parent_id, depth - offset)
+            node.nqueries = nqueries
+            node.reward = reward
+            node.cached_reward = None
+            node.cached_belief = None
+            nodes.append(node)
+            if node.children is not None:
+                stack.extend([(child, node.id) for child in node.children])
+
+        for node in nodes:
+            if node.children is not None:
+                node.child_ids = [child.id for child in node.children]
+        self.parent = None
     
     def print_self(self):
         print self.name
 
 class Tree(object):
-    def __init__(self, f_rew, f_aqu,  belief, pose, path_generator, t, depth, param, c):
+    def __init__(self, f_rew, f_aqu,  belief, pose, path_generator, t, depth, param, c, raster = None, root = None, memo_budget = None, transposition_resolution = None, surrogate_depth = None):
         self.path_generator = path_generator
         self.max_depth = depth
         self.param = param
@@ -320,101 +529,188 @@ class Tree(object):
         self.f_rew = f_rew
         self.aquisition_function = f_aqu
         self.c = c
-
-        self.root = Node(pose, parent = None, name = 'root', action = None, dense_path = None, zvals = None)  
+        # An AcquisitionRaster of f_aqu under the root belief, used for actions taken from the root
+        self.raster = raster
+        # If provided, nodes memoize their immediate reward and, up to this many bytes in total, their belief
+        self.memo_budget = memo_budget
+        self.memo_bytes = 0
+        # If provided, belief nodes that agree in depth, quantized pose and quantized observations are merged
+        self.transposition_resolution = transposition_resolution
+        self.transpositions = {} if transposition_resolution is not None else None
+        # If provided, the belief is no longer conditioned on the simulated observations of actions at or below this depth
+        self.surrogate_depth = surrogate_depth
+        # The nodes visited by the current descent, which may differ from the parent links once nodes are shared
+        self.descent = []
+
+        # A root carried over from the previous planning step keeps the statistics of its subtree
+        if root is not None:
+            self.root = root
+        else:
+            self.root = Node(pose, parent = None, name = 'root', action = None, dense_path = None, zvals = None)  
         #self.build_action_children(self.root) 
 
     def get_best_child(self):
-        return self.root.children[np.argmax([node.nqueries for node in self.root.children])]
+        return self.root.children[np.argmax(self.root.child_stats()[0])]
 
     def backprop(self, leaf_node, reward):
-        if leaf_node.parent is None:
-            leaf_node.nqueries += 1
-            leaf_node.reward += reward
-            #print "Calling backprop on:",
-            #leaf_node.print_self()
-            #print "nqueries:", leaf_node.nqueries, "reward:", leaf_node.reward
-            return
-        else:
-            leaf_node.nqueries += 1
-            leaf_node.reward += reward
+        # Walk up from the leaf to the root
+        node = leaf_node
+        while node is not None:
+            node.nqueries += 1
+            node.reward += reward
             #print "Calling backprop on:",
-            #leaf_node.print_self()
-            #print "nqueries:", leaf_node.nqueries, "reward:", leaf_node.reward
-            self.backprop(leaf_node.parent, reward)
-            return
+            #node.print_self()
+            #print "nqueries:", node.nqueries, "reward:", node.reward
+            node = node.parent
+
+    def backprop_path(self, nodes, reward):
+        # Update the nodes in the order they were visited by the descent
+        for node in nodes:
+            node.nqueries += 1
+            node.reward += reward
     
     def get_next_leaf(self, belief):
         #print "Calling next with root"
-        next_leaf, reward = self.leaf_helper(self.root, reward = 0.0,  belief = belief) 
+        self.descent = []
+        if self.memo_budget is not None:
+            next_leaf, reward = self.memo_leaf_helper(self.root, reward = 0.0, belief = belief, pending = [])
+        else:
+            next_leaf, reward = self.leaf_helper(self.root, reward = 0.0,  belief = belief) 
         #print "Next leaf:", next_leaf
         #print "Reward:", reward
-        self.backprop(next_leaf, reward)
+        if self.transpositions is not None:
+            # A leaf that was selected but not descended into is credited as well
+            if len(self.descent) == 0 or self.descent[-1] is not next_leaf:
+                self.descent.append(next_leaf)
+            self.backprop_path(self.descent, reward)
+        else:
+            self.backprop(next_leaf, reward)
+        return reward
 
     def leaf_helper(self, current_node, reward, belief):
-        if current_node.node_type == 'B':
-            # Root belief node
-            if current_node.depth == self.max_depth:
-                #print "Returning leaf node:", current_node.name, "with reward", reward
-                return current_node, reward
-            # Intermediate belief node
-            else:
-                if current_node.children is None:
-                    self.build_action_children(current_node)
-
-                # If no viable actions are avaliable
-                if current_node.children is None:
+        while True:
+            self.descent.append(current_node)
+            if current_node.node_type == 'B':
+                # Root belief node
+                if current_node.depth == self.max_depth:
+                    #print "Returning leaf node:", current_node.name, "with reward", reward
                     return current_node, reward
+                # Intermediate belief node
+                else:
+                    if current_node.children is None:
+                        self.build_action_children(current_node)
+
+                    # If no viable actions are avaliable
+                    if current_node.children is None:
+                        return current_node, reward
+
+                    child = self.get_next_child(current_node)
+                    #print "Selecting next action child:", child.name
+
+                    # Descend to the child
+                    current_node = child
+                    continue
+
+            # At random node, after selected action from a specific node
+            elif current_node.node_type == 'BA':
+                # Copy old belief
+                #gp_new = copy.copy(current_node.belief) 
+                #gp_new = current_node.belief
+
+                # Sample a new set of observations and form a new belief
+                #xobs = current_node.action
+                obs = np.array(current_node.action)
+                xobs = np.vstack([obs[:,0], obs[:,1]]).T
+
+                r = self.path_reward(xobs, belief, current_node.depth)
+                exact = self.exact_belief(current_node.depth)
+
+                if current_node.children is not None:
+                    alpha = 3.0 / (10.0 * (self.max_depth - current_node.depth) - 3.0)
+                    nchild = len(current_node.children)
+                    #print "Current depth:", current_node.depth, "alpha:", alpha
+                    #print "First:", np.floor(nchild ** alpha)
+                    #print "Second:", np.floor((nchild - 1) ** alpha)
+                    # Under the surrogate the belief children are all equivalent, so no more are added
+                    if not exact or (current_node.depth < self.max_depth - 1 and np.floor(nchild ** alpha) == np.floor((nchild - 1) ** alpha)):
+                        #print "Choosing from among current nodes"
+                        #child = random.choice(current_node.children)
+                        #print "number quieres:", nqueries
+                        nqueries, _ = current_node.child_stats()
+                        child = current_node.children[random.choice(np.flatnonzero(nqueries == nqueries.min()))]
+
+                        belief = self.observe(belief, xobs, self.child_zvals(current_node, child), current_node.depth)
+                        #print "Selcted child:", child.nqueries
+                        current_node, reward = child, reward + r
+                        continue
+
+                if True:
+                    if belief.model is None:
+                        n_points, input_dim = xobs.shape
+                        zmean, zvar = np.zeros((n_points, )), np.eye(n_points) * belief.variance
+                        zobs = np.random.multivariate_normal(mean = zmean, cov = zvar)
+                        zobs = np.reshape(zobs, (n_points, 1))
+                    else:
+                        zobs = belief.posterior_samples(xobs, full_cov = False, size = 1)
 
-                child = self.get_next_child(current_node)
-                #print "Selecting next action child:", child.name
-
-                # Recursive call
-                return self.leaf_helper(child, reward, belief)
+                    belief = self.observe(belief, xobs, zobs, current_node.depth)
+                else:
+                    zobs = belief.posterior_samples(xobs, full_cov = False, size = 1)
 
-        # At random node, after selected action from a specific node
-        elif current_node.node_type == 'BA':
-            # Copy old belief
-            #gp_new = copy.copy(current_node.belief) 
-            #gp_new = current_node.belief
+                child, _ = self.add_belief_child(current_node, zobs)
+                #print "Adding next belief child:", child.name
 
-            # Sample a new set of observations and form a new belief
-            #xobs = current_node.action
-            obs = np.array(current_node.action)
-            xobs = np.vstack([obs[:,0], obs[:,1]]).T
+                # Descend to the child
+                current_node, reward = child, reward + r
+                continue
 
-            if self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
-                r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
-            elif self.f_rew == 'exp_improve':
-                r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
-            elif self.f_rew == 'naive':
-                # param = sample_max_vals(belief, t=self.t, nK=int(self.param[0]))
-                r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)#(param, self.param[1]))
-            elif self.f_rew == 'naive_value':
-                r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
-            else:
-                r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief)
+    def memo_leaf_helper(self, current_node, reward, belief, pending):
+        '''
+        Variant of leaf_helper that memoizes the immediate reward of action nodes and, within the memory budget,
+        the belief of belief nodes. The belief is only brought up to date when a reward or an observation has to
+        be computed, by conditioning the belief of the deepest memoized ancestor on the observations since.
+        Inputs:
+            belief (GP model) the belief of the deepest memoized ancestor; it is never modified
+            pending (list of tuples) the (xobs, zobs) observed along the path since that ancestor
+        '''
+        while True:
+            self.descent.append(current_node)
+            if current_node.node_type == 'B':
+                if current_node.cached_belief is not None:
+                    belief, pending = current_node.cached_belief, []
+                if current_node.depth == self.max_depth:
+                    return current_node, reward
 
-            if current_node.children is not None:
-                alpha = 3.0 / (10.0 * (self.max_depth - current_node.depth) - 3.0)
-                nchild = len(current_node.children)
-                #print "Current depth:", current_node.depth, "alpha:", alpha
-                #print "First:", np.floor(nchild ** alpha)
-                #print "Second:", np.floor((nchild - 1) ** alpha)
-                if current_node.depth < self.max_depth - 1 and np.floor(nchild ** alpha) == np.floor((nchild - 1) ** alpha):
-                    #print "Choosing from among current nodes"
-                    #child = random.choice(current_node.children)
-                    #print "number quieres:", nqueries
-                    child = random.choice(current_node.children)
-                    nqueries = [node.nqueries for node in current_node.children]
-                    child = random.choice([node for node in current_node.children if node.nqueries == min(nqueries)])
-
-                    if True:
-                        belief.add_data(xobs, child.zvals)
-                    #print "Selcted child:", child.nqueries
-                    return self.leaf_helper(child, reward + r, belief)
+                if current_node.children is None:
+                    self.build_action_children(current_node)
+                # If no viable actions are avaliable
+                if current_node.children is None:
+                    return current_node, reward
 
-            if True:
+                child = self.get_next_child(current_node)
+                current_node = child
+                continue
+
+            elif current_node.node_type == 'BA':
+                xobs = self.path_observations(current_node)
+                if current_node.cached_reward is None:
+                    belief, pending = self.condition_belief(belief, pending)
+                    current_node.cached_reward = self.path_reward(xobs, belief, current_node.depth)
+                r = current_node.cached_reward
+                exact = self.exact_belief(current_node.depth)
+
+                if current_node.children is not None:
+                    alpha = 3.0 / (10.0 * (self.max_depth - current_node.depth) - 3.0)
+                    nchild = len(current_node.children)
+                    if not exact or (current_node.depth < self.max_depth - 1 and np.floor(nchild ** alpha) == np.floor((nchild - 1) ** alpha)):
+                        nqueries, _ = current_node.child_stats()
+                        child = current_node.children[random.choice(np.flatnonzero(nqueries == nqueries.min()))]
+                        if exact:
+                            pending = pending + [(xobs, self.child_zvals(current_node, child))]
+                        current_node, reward = child, reward + r
+                        continue
+
+                belief, pending = self.condition_belief(belief, pending)
                 if belief.model is None:
                     n_points, input_dim = xobs.shape
                     zmean, zvar = np.zeros((n_points, )), np.eye(n_points) * belief.variance
@@ -423,36 +719,233 @@ class Tree(object):
                 else:
                     zobs = belief.posterior_samples(xobs, full_cov = False, size = 1)
 
-                belief.add_data(xobs, zobs)
-            else:
-                zobs = belief.posterior_samples(xobs, full_cov = False, size = 1)
-
-            belief.add_data(xobs, zobs)
-            pose_new = current_node.dense_path[-1]
-            child = Node(pose = pose_new, 
-                         parent = current_node, 
-                         name = current_node.name + '_belief' + str(current_node.depth + 1), 
-                         action = None, 
-                         dense_path = None, 
-                         zvals = zobs)
-            #print "Adding next belief child:", child.name
-            current_node.add_children(child)
-
-            # Recursive call
-            return self.leaf_helper(child, reward + r, belief)
+                child, created = self.add_belief_child(current_node, zobs)
+                if exact:
+                    belief = self.observe(belief, xobs, zobs, current_node.depth)
+                    if created:
+                        self.memoize_belief(child, belief)
+
+                current_node, reward = child, reward + r
+                continue
+
+    def add_belief_child(self, parent, zobs):
+        '''
+        Adds the belief child reached by observing zobs along the path of an action node. With a transposition
+        table, a belief node at the same depth whose pose and observations since the root agree up to the
+        resolution is linked instead, so that equivalent beliefs share their statistics and children.
+        Inputs:
+            parent (Node) the action node
+            zobs (float array) the observations along the path of the action
+        Outputs:
+            child (Node) the belief child
+            created (boolean) whether the child is a new node
+        '''
+        pose = parent.dense_path[-1]
+        if self.transpositions is None:
+            child = Node(pose = pose, parent = parent, name = 'belief' + str(parent.depth + 1), action = None, dense_path = None, zvals = zobs)
+            parent.add_children(child)
+            return child, True
+
+        res = self.transposition_resolution
+        obs = np.array(parent.action)
+        cells = np.round(np.hstack([obs[:, 0:2], np.reshape(zobs, (-1, 1))]) / res).astype(int)
+        fingerprint = parent.parent.fingerprint + sum([hash(tuple(cell)) for cell in cells.tolist()])
+        key = (parent.depth + 1, fingerprint) + tuple(np.round(np.array(pose, dtype = float) / res).astype(int).tolist())
+
+        child = self.transpositions.get(key)
+        if child is None:
+            child = Node(pose = pose, parent = parent, name = 'belief' + str(parent.depth + 1), action = None, dense_path = None, zvals = zobs)
+            child.fingerprint = fingerprint
+            self.transpositions[key] = child
+            parent.add_children(child)
+            return child, True
+
+        # Link the existing node, keeping the observations of this edge for later descents
+        if child.parent is not parent and (parent.edge_zvals is None or child not in parent.edge_zvals):
+            if parent.edge_zvals is None:
+                parent.edge_zvals = {}
+            parent.edge_zvals[child] = zobs
+            parent.add_children(child)
+        return child, False
+
+    def child_zvals(self, parent, child):
+        ''' Returns the observations along the edge from an action node to one of its belief children '''
+        if parent.edge_zvals is not None and child in parent.edge_zvals:
+            return parent.edge_zvals[child]
+        return child.zvals
+
+    def exact_belief(self, depth):
+        ''' Whether the belief is conditioned on the simulated observations of actions taken at some depth '''
+        return self.surrogate_depth is None or depth < self.surrogate_depth
+
+    def observe(self, belief, xobs, zobs, depth):
+        '''
+        Returns a copy of the belief conditioned once on the simulated observations zobs along xobs of an action
+        taken at depth, or the belief itself if it is not conditioned at that depth. All search modes condition
+        beliefs through here.
+        '''
+        if not self.exact_belief(depth):
+            return belief
+        belief = copy.copy(belief)
+        belief.add_data(xobs, zobs)
+        return belief
+
+    def condition_belief(self, belief, pending):
+        ''' Returns a copy of the belief conditioned on the pending observations, which are then cleared '''
+        if len(pending) == 0:
+            return belief, pending
+        belief = copy.copy(belief)
+        belief.add_data(np.vstack([x for x, z in pending]), np.vstack([z for x, z in pending]))
+        return belief, []
+
+    def memoize_belief(self, node, belief):
+        ''' Stores the belief of a belief node if it fits in the memory budget '''
+        size = sum([v.nbytes for v in vars(belief).values() if isinstance(v, np.ndarray)])
+        if self.memo_bytes + size <= self.memo_budget:
+            node.cached_belief = belief
+            self.memo_bytes += size
+
+    def path_reward(self, xobs, belief, depth, FVECTOR = False):
+        ''' Evaluates the aquisition function along the observations of a path taken at some depth of the tree '''
+        if self.raster is not None and depth == 0:
+            r = self.raster(time = self.t, xvals = xobs, FVECTOR = FVECTOR)
+        elif self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
+            r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param, FVECTOR = FVECTOR)
+        elif self.f_rew == 'exp_improve':
+            r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
+        elif self.f_rew == 'naive':
+            # param = sample_max_vals(belief, t=self.t, nK=int(self.param[0]))
+            r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param, FVECTOR = FVECTOR)#(param, self.param[1]))
+        elif self.f_rew == 'naive_value':
+            r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param, FVECTOR = FVECTOR)
+        elif FVECTOR:
+            r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, FVECTOR = FVECTOR)
+        else:
+            r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief)
+        return r
+
+    def get_next_leaves(self, belief, batch_size):
+        '''
+        Selects batch_size leaves in one round, using a virtual loss so that the descents spread over the tree.
+        Descents that reach the same belief node share its belief, so the rewards of the actions they select
+        and the observations of the belief children they create are evaluated with one stacked GP call per
+        belief node and depth rather than one call per iteration.
+        Inputs:
+            belief (GP model) the root belief; it is copied, not modified
+            batch_size (int) the number of leaves to select in this round
+        Outputs:
+            rewards (float array) the reward backpropagated by each descent
+        '''
+        paths = [[] for k in xrange(batch_size)]
+        rewards = np.zeros(batch_size)
+
+        # The frontier maps each belief node reached by some descents to its belief and those descents
+        frontier = [(self.root, belief, range(batch_size))]
+        while len(frontier) > 0:
+            next_frontier = []
+            for current_node, current_belief, descents in frontier:
+                if current_node.depth == self.max_depth:
+                    continue
+                if current_node.children is None:
+                    self.build_action_children(current_node)
+                # If no viable actions are avaliable
+                if current_node.children is None:
+                    continue
+
+                # Select an action for each descent; the virtual visit steers the following descents elsewhere. Nodes
+                # hash by address, so ordered maps keep the order of the GP calls, and the search, reproducible
+                selected = OrderedDict()
+                for k in descents:
+                    child = self.get_next_child(current_node)
+                    child.nqueries += 1
+                    paths[k].append(child)
+                    selected.setdefault(child, []).append(k)
+
+                action_nodes = selected.keys()
+                xobs = [self.path_observations(node) for node in action_nodes]
+                r = self.batch_path_reward(xobs, current_belief, current_node.depth)
+
+                # Progressive widening at each action node, deferring the observations of new belief children
+                reached = OrderedDict()
+                new_children = []
+                for node, obs, node_reward in zip(action_nodes, xobs, r):
+                    for k in selected[node]:
+                        rewards[k] += node_reward
+                        child = None
+                        if node.children is not None:
+                            alpha = 3.0 / (10.0 * (self.max_depth - node.depth) - 3.0)
+                            nchild = len(node.children)
+                            if not self.exact_belief(node.depth) or (node.depth < self.max_depth - 1 and np.floor(nchild ** alpha) == np.floor((nchild - 1) ** alpha)):
+                                nqueries, _ = node.child_stats()
+                                child = node.children[random.choice(np.flatnonzero(nqueries == nqueries.min()))]
+                        if child is None:
+                            child = Node(pose = node.dense_path[-1], 
+                                         parent = node, 
+                                         name = 'belief' + str(node.depth + 1), 
+                                         action = None, 
+                                         dense_path = None, 
+                                         zvals = None)
+                            node.add_children(child)
+                            new_children.append((child, obs))
+                        child.nqueries += 1
+                        paths[k].append(child)
+                        reached.setdefault(child, (obs, []))[1].append(k)
+
+                self.batch_observations(new_children, current_belief)
+
+                for child, (obs, ks) in reached.items():
+                    next_frontier.append((child, self.observe(current_belief, obs, child.zvals, current_node.depth), ks))
+            frontier = next_frontier
+
+        # The visits were already counted by the virtual loss, so only the rewards are backpropagated
+        self.root.nqueries += batch_size
+        for k in xrange(batch_size):
+            self.root.reward += rewards[k]
+            for node in paths[k]:
+                node.reward += rewards[k]
+        return rewards
+
+    def path_observations(self, node):
+        ''' Returns the observation locations along the path of an action node '''
+        obs = np.array(node.action)
+        return np.vstack([obs[:,0], obs[:,1]]).T
+
+    def batch_path_reward(self, xobs, belief, depth):
+        ''' Evaluates the reward of several paths under a shared belief; additive rewards are evaluated in one stacked call '''
+        if self.f_rew in ['mean', 'mes', 'naive', 'naive_value'] or (self.raster is not None and depth == 0):
+            f = self.path_reward(np.vstack(xobs), belief, depth, FVECTOR = True)
+            splits = np.cumsum([obs.shape[0] for obs in xobs])[:-1]
+            return [np.sum(part) for part in np.split(np.asarray(f).ravel(), splits)]
+        return [self.path_reward(obs, belief, depth) for obs in xobs]
+
+    def batch_observations(self, children, belief):
+        ''' Samples the observations of several new belief children under a shared belief in one stacked call '''
+        if len(children) == 0:
+            return
+        xobs = np.vstack([obs for child, obs in children])
+        if belief.model is None:
+            n_points, input_dim = xobs.shape
+            zobs = np.random.normal(0.0, np.sqrt(belief.variance), size = (n_points, 1))
+        else:
+            zobs = belief.posterior_samples(xobs, full_cov = False, size = 1)
+
+        start = 0
+        for child, obs in children:
+            child.zvals = zobs[start:start + obs.shape[0]]
+            start += obs.shape[0]
 
     def get_next_child(self, current_node):
-        vals = {}
         # e_d = 0.5 * (1.0 - (3.0/10.0*(self.max_depth - current_node.depth)))
         e_d = 0.5 * (1.0 - (3.0/(10.0*(self.max_depth - current_node.depth))))
-        for i, child in enumerate(current_node.children):
-            #print "Considering child:", child.name, "with queries:", child.nqueries
-            if child.nqueries == 0:
-                return child
-            vals[child] = child.reward/float(child.nqueries) + self.c * np.sqrt((float(current_node.nqueries) ** e_d)/float(child.nqueries)) 
-            #vals[child] = child.reward/float(child.nqueries) + self.c * np.sqrt(np.log(float(current_node.nqueries))/float(child.nqueries)) 
+        nqueries, reward = current_node.child_stats()
+        # Unvisited children are selected first
+        unvisited = np.flatnonzero(nqueries == 0)
+        if len(unvisited) > 0:
+            return current_node.children[unvisited[0]]
+        vals = reward / nqueries + self.c * np.sqrt((float(current_node.nqueries) ** e_d) / nqueries)
+        #vals = reward / nqueries + self.c * np.sqrt(np.log(float(current_node.nqueries)) / nqueries)
         # Return the max node, or a random node if the value is equal
-        return random.choice([key for key in vals.keys() if vals[key] == max(vals.values())])
+        return current_node.children[random.choice(np.flatnonzero(vals == vals.max()))]
         
     def build_action_children(self, parent):
         actions, dense_paths = self.path_generator.get_path_set(parent.pose)
@@ -465,7 +958,7 @@ class Tree(object):
             #print "Action:", i
             parent.add_children(Node(pose = parent.pose, 
                                     parent = parent, 
-                                    name = parent.name + '_action' + str(i), 
+                                    name = 'action' + str(i), 
                                     action = actions[action], 
                                     dense_path = dense_paths[action],
                                     zvals = None))
@@ -475,43 +968,70 @@ class Tree(object):
         print "# nodes in tree:", counter
 
     def print_helper(self, cur_node):
-        if cur_node.children is None:
-            #cur_node.print_self()
-            #print cur_node.name
-            return 1
-        else:
-            #cur_node.print_self()
-            #print "\n"
-            counter = 0
-            for child in cur_node.children:
-                counter += self.print_helper(child)
-            return counter
+        return self.tree_stats(cur_node)['leaves']
+
+    def tree_stats(self, cur_node = None):
+        '''
+        Walks the tree below a node (the root by default) with an explicit stack
+        Outputs:
+            stats (dictionary) the number of nodes, of leaves and the maximum depth below the node
+        '''
+        if cur_node is None:
+            cur_node = self.root
+        stats = {'nodes': 0, 'leaves': 0, 'max_depth': 0}
+        # Nodes shared through a transposition table are counted once
+        seen = set()
+        stack = [cur_node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            stats['nodes'] += 1
+            stats['max_depth'] = max(stats['max_depth'], node.depth)
+            if node.children is None:
+                stats['leaves'] += 1
+            else:
+                stack.extend(node.children)
+        return stats
 
 ''' Inherit class, that implements more standard MCTS, and assumes MLE observation to deal with continuous spaces '''
 class BeliefTree(Tree):
-    def __init__(self, f_rew, f_aqu,  belief, pose, path_generator, t, depth, param, c):
-        super(BeliefTree, self).__init__(f_rew, f_aqu,  belief, pose, path_generator, t, depth, param, c)
+    def __init__(self, f_rew, f_aqu,  belief, pose, path_generator, t, depth, param, c, raster = None, root = None, memo_budget = None, transposition_resolution = None, surrogate_depth = None, value_estimator = None):
+        super(BeliefTree, self).__init__(f_rew, f_aqu,  belief, pose, path_generator, t, depth, param, c, raster, root, memo_budget, transposition_resolution, surrogate_depth)
+        # If provided, a ValueEstimator that truncates the random rollouts at its depth
+        self.value_estimator = value_estimator
 
     # Max Reward-based node selection
     def get_best_child(self):
-        return self.root.children[np.argmax([node.nqueries for node in self.root.children])]
+        return self.root.children[np.argmax(self.root.child_stats()[0])]
 
     def random_rollouts(self, current_node, reward, belief):
         cur_depth = current_node.depth
         pose = current_node.pose
+        # The features and the reward so far of the state at the truncation depth, if the rollout went on past it
+        sample = None
         while cur_depth <= self.max_depth:
+            if self.value_estimator is not None and sample is None and cur_depth == self.value_estimator.depth:
+                x = self.value_estimator.features(belief, pose, self.max_depth - cur_depth + 1)
+                if self.value_estimator.truncate():
+                    return reward + self.value_estimator.predict(x)
+                sample = (x, reward)
+
             actions, dense_paths = self.path_generator.get_path_set(pose)
             keys = actions.keys()
             # No viable trajectories from current location
             if len(actions) <= 1:
-                return reward
+                break
 
             #select a random action
             a = np.random.randint(0, len(actions) - 1)
             obs = np.array(actions[keys[a]])
             xobs = np.vstack([obs[:,0], obs[:,1]]).T
 
-            if self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
+            if self.raster is not None and cur_depth == 0:
+                r = self.raster(time = self.t, xvals = xobs)
+            elif self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
                 r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
             elif self.f_rew == 'exp_improve':
                 r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
@@ -531,115 +1051,430 @@ class BeliefTree(Tree):
                 else:
                     zobs, _= belief.predict_value(xobs)
 
-                belief.add_data(xobs, zobs)
+                belief = self.observe(belief, xobs, zobs, cur_depth)
             else:
                 zobs, _= belief.predict_value(xobs)
 
-            belief.add_data(xobs, zobs)
             pose = dense_paths[keys[a]][-1]
             reward += r
             cur_depth += 1
 
+        # A rollout that ran to full depth is a sample of the return that follows the truncation depth
+        if sample is not None:
+            self.value_estimator.update(sample[0], reward - sample[1])
         return reward
 
     def leaf_helper(self, current_node, reward, belief):
-        if current_node.node_type == 'B':
-            # belief node
-            if current_node.depth == self.max_depth:
-                #print "Returning leaf node:", current_node.name, "with reward", reward
-                return current_node, reward
-            # Intermediate belief node
-            else:
+        while True:
+            self.descent.append(current_node)
+            if current_node.node_type == 'B':
+                # belief node
+                if current_node.depth == self.max_depth:
+                    #print "Returning leaf node:", current_node.name, "with reward", reward
+                    return current_node, reward
+                # Intermediate belief node
+                else:
+                    if current_node.children is None:
+                        self.build_action_children(current_node)
+
+                    # If no viable actions are avaliable
+                    if current_node.children is None:
+                        return current_node, reward
+
+                    child, full_action_set  = self.get_next_child(current_node)
+                    #print "Selecting next action child:", child.name
+                    #print "Full action set?", full_action_set
+
+                    if full_action_set:
+                        # Descend to the child
+                        current_node = child
+                        continue
+                    else:
+                        # Do random rollouts
+                        #print "Doing random rollouts!"
+                        rollout_reward = self.random_rollouts(current_node, reward, belief) 
+                        #print "Rollout reward:", rollout_reward
+                        return child, rollout_reward
+
+            # At random node, after selected action from a specific node
+            elif current_node.node_type == 'BA':
+                # Copy old belief
+                #gp_new = copy.copy(current_node.belief) 
+                #gp_new = current_node.belief
+
+                # Sample a new set of observations and form a new belief
+                #xobs = current_node.action
+                obs = np.array(current_node.action)
+                xobs = np.vstack([obs[:,0], obs[:,1]]).T
+
+                if self.raster is not None and current_node.depth == 0:
+                    r = self.raster(time = self.t, xvals = xobs)
+                elif self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
+                    r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
+                elif self.f_rew == 'exp_improve':
+                    r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
+                elif self.f_rew == 'naive':
+                    r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
+                elif self.f_rew == 'naive_value':
+                    r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
+                else:
+                    r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief)
+
+                if True:
+                    # ''Simulate'' the maximum likelihood observation
+                    if belief.model is None:
+                        n_points, input_dim = xobs.shape
+                        zobs = np.zeros((n_points, ))
+                        zobs = np.reshape(zobs, (n_points, 1))
+                    else:
+                        zobs, _= belief.predict_value(xobs)
+
+                    belief = self.observe(belief, xobs, zobs, current_node.depth)
+                else:
+                    zobs, _= belief.predict_value(xobs)
+
+                child, _ = self.add_belief_child(current_node, zobs)
+                #print "Adding next belief child:", child.name
+
+                # Descend to the child
+                current_node, reward = child, reward + r
+                continue
+
+    def memo_leaf_helper(self, current_node, reward, belief, pending):
+        '''
+        Variant of leaf_helper that memoizes the immediate reward of action nodes and, within the memory budget,
+        the belief of belief nodes. Since observations are maximum likelihood, an action node has a single belief
+        child, which is revisited instead of being recreated.
+        Inputs:
+            belief (GP model) the belief of the deepest memoized ancestor; it is never modified
+            pending (list of tuples) the (xobs, zobs) observed along the path since that ancestor
+        '''
+        while True:
+            self.descent.append(current_node)
+            if current_node.node_type == 'B':
+                if current_node.cached_belief is not None:
+                    belief, pending = current_node.cached_belief, []
+                if current_node.depth == self.max_depth:
+                    return current_node, reward
+
                 if current_node.children is None:
                     self.build_action_children(current_node)
-
                 # If no viable actions are avaliable
                 if current_node.children is None:
                     return current_node, reward
 
-                child, full_action_set  = self.get_next_child(current_node)
-                #print "Selecting next action child:", child.name
-                #print "Full action set?", full_action_set
-
+                child, full_action_set = self.get_next_child(current_node)
                 if full_action_set:
-                    # Recursive call
-                    return self.leaf_helper(child, reward, belief)
+                    current_node = child
+                    continue
                 else:
-                    # Do random rollouts
-                    #print "Doing random rollouts!"
-                    rollout_reward = self.random_rollouts(current_node, reward, belief) 
-                    #print "Rollout reward:", rollout_reward
+                    # Rollouts modify the belief they are given
+                    belief, pending = self.condition_belief(belief, pending)
+                    rollout_reward = self.random_rollouts(current_node, reward, copy.copy(belief))
                     return child, rollout_reward
 
-        # At random node, after selected action from a specific node
-        elif current_node.node_type == 'BA':
-            # Copy old belief
-            #gp_new = copy.copy(current_node.belief) 
-            #gp_new = current_node.belief
+            elif current_node.node_type == 'BA':
+                xobs = self.path_observations(current_node)
+                if current_node.cached_reward is None:
+                    belief, pending = self.condition_belief(belief, pending)
+                    current_node.cached_reward = self.path_reward(xobs, belief, current_node.depth)
+                r = current_node.cached_reward
 
-            # Sample a new set of observations and form a new belief
-            #xobs = current_node.action
-            obs = np.array(current_node.action)
-            xobs = np.vstack([obs[:,0], obs[:,1]]).T
+                if current_node.children is not None:
+                    child = current_node.children[0]
+                    if self.exact_belief(current_node.depth):
+                        pending = pending + [(xobs, self.child_zvals(current_node, child))]
+                    current_node, reward = child, reward + r
+                    continue
 
-            if self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
-                r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
-            elif self.f_rew == 'exp_improve':
-                r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
-            elif self.f_rew == 'naive':
-                r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
-            elif self.f_rew == 'naive_value':
-                r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief, param = self.param)
-            else:
-                r = self.aquisition_function(time = self.t, xvals = xobs, robot_model = belief)
-
-            if True:
                 # ''Simulate'' the maximum likelihood observation
+                belief, pending = self.condition_belief(belief, pending)
                 if belief.model is None:
                     n_points, input_dim = xobs.shape
-                    zobs = np.zeros((n_points, ))
-                    zobs = np.reshape(zobs, (n_points, 1))
+                    zobs = np.zeros((n_points, 1))
                 else:
                     zobs, _= belief.predict_value(xobs)
 
-                belief.add_data(xobs, zobs)
-            else:
-                zobs, _= belief.predict_value(xobs)
+                child, created = self.add_belief_child(current_node, zobs)
+                if self.exact_belief(current_node.depth):
+                    belief = self.observe(belief, xobs, zobs, current_node.depth)
+                    if created:
+                        self.memoize_belief(child, belief)
 
-            belief.add_data(xobs, zobs)
-            pose_new = current_node.dense_path[-1]
-            child = Node(pose = pose_new, 
-                         parent = current_node, 
-                         name = current_node.name + '_belief' + str(current_node.depth + 1), 
-                         action = None, 
-                         dense_path = None, 
-                         zvals = zobs)
-            #print "Adding next belief child:", child.name
-            current_node.add_children(child)
-
-            # Recursive call
-            return self.leaf_helper(child, reward + r, belief)
+                current_node, reward = child, reward + r
+                continue
 
     ''' Returns the next most promising child of a belief node, and a FLAG indicating if belief node is fully explored '''
     def get_next_child(self, current_node):
-        vals = {}
-        for i, child in enumerate(current_node.children):
-            #print "Considering child:", child.name, "with queries:", child.nqueries
-            if child.nqueries == 0:
-                return child, False
-            vals[child] = child.reward/float(child.nqueries) + self.c * np.sqrt(2.0*np.log(float(current_node.nqueries))/float(child.nqueries)) 
+        nqueries, reward = current_node.child_stats()
+        unvisited = np.flatnonzero(nqueries == 0)
+        if len(unvisited) > 0:
+            return current_node.children[unvisited[0]], False
+        vals = reward / nqueries + self.c * np.sqrt(2.0 * np.log(float(current_node.nqueries)) / nqueries)
         # Return the max node, or a random node if the value is equal
-        return random.choice([key for key in vals.keys() if vals[key] == max(vals.values())]), True
+        return current_node.children[random.choice(np.flatnonzero(vals == vals.max()))], True
         
 
 
+class ValueEstimator(object):
+    '''
+    Online ridge regression of the return of the remainder of a random rollout on cheap features of its state:
+    the pose, the number of remaining steps and the predicted mean and standard deviation of the belief at the
+    pose. It is fitted from rollouts that run to full depth; once warmed up, rollouts that reach the truncation
+    depth stop there and add the estimate, except for one in every refit_interval, which keeps fitting it.
+    '''
+    NFEATURES = 8
+
+    def __init__(self, depth, warmup = 50, regularization = 1.0, refit_interval = 10):
+        '''
+        Inputs:
+            depth (int) the tree depth at which rollouts are truncated
+            warmup (int) the number of samples fitted before rollouts are truncated
+            regularization (float) the ridge penalty on the weights
+            refit_interval (int) one in this many rollouts reaching the truncation depth runs to full depth
+        '''
+        self.depth = depth
+        self.warmup = warmup
+        self.refit_interval = refit_interval
+        self.A = regularization * np.eye(self.NFEATURES)
+        self.b = np.zeros(self.NFEATURES)
+        self.weights = None
+        self.nsamples = 0
+        self.ntruncated = 0
+
+    def features(self, belief, pose, steps):
+        ''' Features of the state of a rollout with the given number of steps remaining '''
+        mu, var = belief.predict_value(np.array([[pose[0], pose[1]]]))
+        heading = pose[2] if len(pose) > 2 else 0.0
+        return np.array([1.0, pose[0], pose[1], np.cos(heading), np.sin(heading), steps, float(mu), np.sqrt(max(float(var), 0.0))])
+
+    def update(self, x, y):
+        ''' Adds a sample of the return y that followed a state with features x '''
+        self.A += np.outer(x, x)
+        self.b += y * x
+        self.nsamples += 1
+        self.weights = None
+
+    def predict(self, x):
+        ''' Estimates the return that follows a state with features x '''
+        if self.weights is None:
+            self.weights = np.linalg.solve(self.A, self.b)
+        return float(np.dot(self.weights, x))
+
+    def truncate(self):
+        ''' Decides whether the rollout that reached the truncation depth should stop there '''
+        if self.nsamples < self.warmup:
+            return False
+        self.ntruncated += 1
+        return self.ntruncated % self.refit_interval != 0
+
+class SearchStats(object):
+    '''
+    Counters and timers of the phases of a tree search and of the GP operations performed during it. A tree
+    and a belief are only instrumented between instrument and release, so a search without statistics does
+    not pay for them. Timers are inclusive: e.g. the evaluation phase contains the GP predictions made by the
+    aquisition function.
+    '''
+    # The phase each instrumented tree method is accounted to
+    TREE_PHASES = {'get_next_child': 'selection',
+                   'build_action_children': 'expansion',
+                   'add_belief_child': 'expansion',
+                   'path_reward': 'evaluation',
+                   'random_rollouts': 'rollout',
+                   'backprop': 'backprop',
+                   'backprop_path': 'backprop'}
+    GP_OPERATIONS = ['add_data', 'predict_value', 'posterior_samples']
+
+    def __init__(self):
+        self.counts = {}
+        self.times = {}
+        self.iterations = 0
+        self.search_time = 0.0
+        self.nodes = 0
+        self.depth_histogram = []
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def record(self, name, elapsed):
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.times[name] = self.times.get(name, 0.0) + elapsed
+
+    def timed(self, name, f):
+        ''' Wraps a function so that its calls are counted and timed under name '''
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.record(name, time.time() - start)
+        return wrapper
+
+    def instrument(self, tree, belief):
+        '''
+        Times the phases of a tree and the GP operations of a belief and of all its copies, until release is
+        called.
+        '''
+        for method, phase in self.TREE_PHASES.items():
+            if hasattr(tree, method):
+                setattr(tree, method, self.timed(phase, getattr(tree, method)))
+        self.aquisition_function = tree.aquisition_function
+        tree.aquisition_function = self.timed('aquisition', tree.aquisition_function)
+
+        self.instrument_belief(belief)
+
+    def instrument_belief(self, belief):
+        ''' Times the GP operations of a belief; copies of the belief rebind them to themselves (see GPModel.__copy__) '''
+        for op in self.GP_OPERATIONS:
+            setattr(belief, op, self.timed('gp_' + op, getattr(belief.__class__, op).__get__(belief)))
+        belief.search_stats = self
+
+    def release(self, tree, belief):
+        ''' Removes the instrumentation from a tree and a belief '''
+        for method in self.TREE_PHASES.keys():
+            if method in vars(tree):
+                delattr(tree, method)
+        tree.aquisition_function = self.aquisition_function
+        del self.aquisition_function
+        for op in self.GP_OPERATIONS:
+            if op in vars(belief):
+                delattr(belief, op)
+        del belief.search_stats
+
+    def add_tree(self, tree):
+        ''' Records the size and the depth histogram of a searched tree '''
+        store = tree.root.store
+        self.nodes += store.size
+        self.add_histogram(np.bincount(store.depth[:store.size]))
+
+    def add_histogram(self, histogram):
+        total = np.zeros(max(len(histogram), len(self.depth_histogram)), dtype = int)
+        total[:len(histogram)] += np.asarray(histogram, dtype = int)
+        total[:len(self.depth_histogram)] += np.asarray(self.depth_histogram, dtype = int)
+        self.depth_histogram = total.tolist()
+
+    def merge(self, other):
+        ''' Adds the statistics of another search, e.g. of a root-parallel worker '''
+        for name in other.counts.keys():
+            self.counts[name] = self.counts.get(name, 0) + other.counts[name]
+            self.times[name] = self.times.get(name, 0.0) + other.times[name]
+        self.nodes += other.nodes
+        self.add_histogram(other.depth_histogram)
+
+    def as_dict(self):
+        ''' Flattens the statistics into a dictionary of numbers, except for the depth histogram which is a list '''
+        stats = {'iterations': self.iterations,
+                 'search_time': self.search_time,
+                 'nodes': self.nodes,
+                 'depth_histogram': self.depth_histogram,
+                 'cache_hits': self.cache_hits,
+                 'cache_misses': self.cache_misses,
+                 'cache_hit_rate': self.cache_hits / float(max(self.cache_hits + self.cache_misses, 1))}
+        for name in self.counts.keys():
+            stats['count_' + name] = self.counts[name]
+            stats['time_' + name] = self.times[name]
+        return stats
+
+    def report(self):
+        ''' Prints and logs the statistics, one line per phase '''
+        print "Search statistics:", self.iterations, "iterations in", str(self.search_time) + "s,", self.nodes, "nodes, depth histogram", self.depth_histogram
+        logger.info("Search statistics: {} iterations in {}s, {} nodes, depth histogram {}".format(self.iterations, self.search_time, self.nodes, self.depth_histogram))
+        for name in sorted(self.counts.keys()):
+            print "\t", name, ":", self.counts[name], "calls in", str(self.times[name]) + "s"
+            logger.info("\t{}: {} calls in {}s".format(name, self.counts[name], self.times[name]))
+        if self.cache_hits + self.cache_misses > 0:
+            print "\tpath cache hit rate:", self.as_dict()['cache_hit_rate']
+            logger.info("\tpath cache hit rate: {}".format(self.as_dict()['cache_hit_rate']))
+
+def root_parallel_worker(job):
+    '''
+    Grow an independent copy of a search tree and report the statistics of its root children. Defined at
+    module level so that it can be dispatched to a worker process.
+    Inputs:
+        job (tuple) of the unexpanded tree, the belief snapshot, the number of iterations, the RNG seed, the leaf
+            batch size, the absolute wall-clock deadline (or None) and whether to collect search statistics
+    Outputs:
+        iterations (int) the number of iterations run by the worker
+        stats (list of tuples) the (nqueries, reward) of each root child, or None if the root has no children
+        search_stats (SearchStats) the statistics of the worker's search, or None
+    '''
+    tree, belief, iterations, seed, batch_size, deadline, collect_stats = job
+    # Each worker draws from its own random stream so that the trees explore differently
+    np.random.seed(seed)
+    random.seed(seed)
+
+    search_stats = None
+    if collect_stats:
+        search_stats = SearchStats()
+        search_stats.instrument(tree, belief)
+
+    # Without a deadline, run exactly the given iterations; with one, run at least them and until the deadline
+    i = 0
+    while i < iterations or (deadline is not None and time.time() < deadline):
+        if batch_size is not None:
+            n = batch_size if deadline is not None else min(batch_size, iterations - i)
+            tree.get_next_leaves(copy.copy(belief), n)
+            i += n
+        else:
+            gp = copy.copy(belief)
+            tree.get_next_leaf(gp)
+            i += 1
+
+    if search_stats is not None:
+        search_stats.release(tree, belief)
+        search_stats.add_tree(tree)
+
+    if tree.root.children is None:
+        return i, None, search_stats
+    return i, [(child.nqueries, child.reward) for child in tree.root.children], search_stats
+
 class cMCTS(MCTS):
     '''Class that establishes a MCTS for nonmyopic planning'''
-    def __init__(self, computation_budget, belief, initial_pose, rollout_length, path_generator, aquisition_function, f_rew, T, aq_param = None, use_cost = False, tree_type = 'dpw'):
+    def __init__(self, computation_budget, belief, initial_pose, rollout_length, path_generator, aquisition_function, f_rew, T, aq_param = None, use_cost = False, tree_type = 'dpw', max_val_sampler = None, raster_resolution = None, n_workers = None, batch_size = None, deadline = None, min_iterations = 0, root = None, memo_budget = None, transposition_resolution = None, surrogate_depth = None, collect_stats = False, convergence_confidence = None, convergence_interval = 10, value_estimator = None, max_val_workers = None):
         # Call the constructor of the super class
-        super(cMCTS, self).__init__(computation_budget, belief, initial_pose, rollout_length, path_generator, aquisition_function, f_rew, T, aq_param, use_cost)
+        super(cMCTS, self).__init__(computation_budget, belief, initial_pose, rollout_length, path_generator, aquisition_function, f_rew, T, aq_param, use_cost, deadline = deadline, min_iterations = min_iterations)
         self.tree_type = tree_type
         self.aq_param = aq_param
+        # If provided, a MaxValueSampler that carries the sampled max-values over from the previous planning step
+        self.max_val_sampler = max_val_sampler
+        # If provided, the number of threads the local searches of the max-value sampling are spread across
+        self.max_val_workers = max_val_workers
+        # If provided, the resolution of the aquisition raster used to score the root actions of additive rewards
+        self.raster_resolution = raster_resolution
+        # If greater than one, the computation budget is split over this many independent trees grown in parallel
+        self.n_workers = n_workers
+        # If provided, a root returned by reroot at the previous planning step, whose subtree is searched further
+        if root is not None and not np.allclose(root.pose, initial_pose):
+            root = None
+        self.root = root
+        self.best_child = None
+        # If provided, nodes memoize their immediate reward and, up to this many bytes, their belief
+        self.memo_budget = memo_budget
+        # If provided, the number of leaves selected per round of the batched tree search
+        self.batch_size = batch_size
+        if self.batch_size is not None and self.tree_type != 'dpw':
+            raise ValueError('Batched tree search is only avaliable for the \'dpw\' tree type')
+        # If provided, the resolution of the transposition table that merges equivalent belief nodes
+        self.transposition_resolution = transposition_resolution
+        if self.transposition_resolution is not None and self.batch_size is not None:
+            raise ValueError('Transposition tables are not avaliable with batched tree search')
+        # If provided, the depth from which the tree search stops conditioning its belief on simulated observations
+        self.surrogate_depth = surrogate_depth
+        if self.surrogate_depth is not None and self.surrogate_depth < 1:
+            raise ValueError('The surrogate depth must be at least 1, so that the root actions are simulated exactly')
+        # If set, choose_trajectory collects a SearchStats of the phases of the tree search in self.stats
+        self.collect_stats = collect_stats
+        self.stats = None
+        # If provided, the search stops once the root decision is settled at this confidence (in standard errors),
+        # checking every convergence_interval iterations; root-parallel search always runs to the budget
+        self.convergence_confidence = convergence_confidence
+        self.convergence_interval = convergence_interval
+        self.next_check = convergence_interval
+        # Number, sum and sum of squares of the returns of the iterations, for the standard error of the root values
+        self.returns = [0, 0.0, 0.0]
+        # If provided, a ValueEstimator that truncates the random rollouts of a 'belief' tree
+        self.value_estimator = value_estimator
+        if self.value_estimator is not None and self.tree_type != 'belief':
+            raise ValueError('Value estimation is only avaliable for the \'belief\' tree type, which performs rollouts')
 
         # The differnt constatns use logarthmic vs polynomical exploriation
         if self.f_rew == 'mean':
@@ -660,57 +1495,114 @@ class cMCTS(MCTS):
             self.c = 1.0
         print "Setting c to :", self.c
 
-    def choose_trajectory(self, t):
-        #Main function loop which makes the tree and selects the best child
-        #Output: path to take, cost of that path
-
+    def search_param(self, t):
+        '''
+        Samples the parameters of the aquisition function for this planning step and, if enabled, builds the
+        aquisition raster used for the root actions
+        Outputs:
+            param (tuple or list or None) the aquisition function parameters
+            raster (AcquisitionRaster or None)
+        '''
         # randomly sample the world for entropy search function
-        if self.f_rew == 'mes':
-            self.max_val, self.max_locs, self.target  = sample_max_vals(self.GP, t = t, visualize=True)
+        if self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
+            if self.max_val_sampler is not None:
+                self.max_val, self.max_locs, self.target  = self.max_val_sampler.sample(self.GP, t = t, visualize=True)
+            else:
+                self.max_val, self.max_locs, self.target  = sample_max_vals(self.GP, t = t, visualize=True, obstacles = self.path_generator.obstacle_world, n_workers = self.max_val_workers)
             param = (self.max_val, self.max_locs, self.target)
         elif self.f_rew == 'exp_improve':
             param = [self.current_max]
         elif self.f_rew == 'naive' or self.f_rew == 'naive_value':
-            self.max_val, self.max_locs, self.target  = sample_max_vals(self.GP, t=t, nK=int(self.aq_param[0]), visualize=True, f_rew=self.f_rew)
+            if self.max_val_sampler is not None:
+                self.max_val, self.max_locs, self.target  = self.max_val_sampler.sample(self.GP, t = t, visualize=True)
+            else:
+                self.max_val, self.max_locs, self.target  = sample_max_vals(self.GP, t=t, nK=int(self.aq_param[0]), visualize=True, f_rew=self.f_rew, obstacles = self.path_generator.obstacle_world, n_workers = self.max_val_workers)
             param = ((self.max_val, self.max_locs, self.target), self.aq_param[1])
         else:
             param = None
 
+        # Additive rewards of the root actions are evaluated under the root belief, so they can be looked up in a raster
+        raster = None
+        if self.raster_resolution is not None and self.GP.xvals is not None and self.f_rew in ['mean', 'mes', 'naive', 'naive_value']:
+            raster = AcquisitionRaster(self.aquisition_function, t, self.GP, param, resolution = self.raster_resolution)
+        return param, raster
+
+    def choose_trajectory(self, t):
+        #Main function loop which makes the tree and selects the best child
+        #Output: path to take, cost of that path
+        param, raster = self.search_param(t)
+
         # initialize tree
         if self.tree_type == 'dpw':
-            self.tree = Tree(self.f_rew, self.aquisition_function, self.GP, self.cp, self.path_generator, t, depth = self.rl, param = param, c = self.c)
+            self.tree = Tree(self.f_rew, self.aquisition_function, self.GP, self.cp, self.path_generator, t, depth = self.rl, param = param, c = self.c, raster = raster, root = self.root, memo_budget = self.memo_budget, transposition_resolution = self.transposition_resolution, surrogate_depth = self.surrogate_depth)
         elif self.tree_type == 'belief':
-            self.tree = BeliefTree(self.f_rew, self.aquisition_function, self.GP, self.cp, self.path_generator, t, depth = self.rl, param = param, c = self.c)
+            self.tree = BeliefTree(self.f_rew, self.aquisition_function, self.GP, self.cp, self.path_generator, t, depth = self.rl, param = param, c = self.c, raster = raster, root = self.root, memo_budget = self.memo_budget, transposition_resolution = self.transposition_resolution, surrogate_depth = self.surrogate_depth, value_estimator = self.value_estimator)
         else:
             raise ValueError('Tree type must be one of either \'dpw\' or \'belief\'')
         #self.tree.get_next_leaf()
         #print self.tree.root.children[0].children
 
-        time_start = time.time()            
-        # while we still have time to compute, generate the tree
-        i = 0
-        while i < self.comp_budget:#time.time() - time_start < self.comp_budget:
-            i += 1
-            gp = copy.copy(self.GP)
-            self.tree.get_next_leaf(gp)
+        # Path cache counters before the search, if the path generator is cached
+        cache_counts = (getattr(self.path_generator, 'hits', 0), getattr(self.path_generator, 'misses', 0))
+        parallel = self.n_workers is not None and self.n_workers > 1
+        if self.collect_stats:
+            self.stats = SearchStats()
+            if not parallel:
+                self.stats.instrument(self.tree, self.GP)
 
-            if True:
+        time_start = time.time()            
+        if parallel:
+            i = self.root_parallel_search(time_start)
+        elif self.batch_size is not None:
+            # select a batch of leaves per round until the budget is spent
+            i = 0
+            while self.keep_searching(i, time_start):
+                n = self.batch_size if self.deadline is not None else min(self.batch_size, self.comp_budget - i)
+                self.record_returns(self.tree.get_next_leaves(copy.copy(self.GP), n))
+                i += n
+        else:
+            # while we still have time to compute, generate the tree
+            i = 0
+            while self.keep_searching(i, time_start):
+                i += 1
                 gp = copy.copy(self.GP)
+                self.record_returns([self.tree.get_next_leaf(gp)])
+
+                if True:
+                    gp = copy.copy(self.GP)
         time_end = time.time()
+        self.iterations = i
         print "Rollouts completed in", str(time_end - time_start) +  "s"
         print "Number of rollouts:", i
+        logger.info("Number of rollouts: {} in {}s".format(i, time_end - time_start))
+        if self.stats is not None:
+            if not parallel:
+                self.stats.release(self.tree, self.GP)
+                self.stats.add_tree(self.tree)
+            self.stats.iterations = i
+            self.stats.search_time = time_end - time_start
+            # Workers use their own copies of the path generator, so only the main process is counted
+            self.stats.cache_hits = getattr(self.path_generator, 'hits', 0) - cache_counts[0]
+            self.stats.cache_misses = getattr(self.path_generator, 'misses', 0) - cache_counts[1]
+            self.stats.report()
+        # A deadline may pass before the first iteration; the root actions are still needed to return one
+        if self.tree.root.children is None:
+            self.tree.build_action_children(self.tree.root)
         self.tree.print_tree()
 
-        print [(node.nqueries, node.reward/node.nqueries) for node in self.tree.root.children]
+        # With a split budget, a worker may not have visited every root child
+        print [(node.nqueries, node.reward/max(node.nqueries, 1)) for node in self.tree.root.children]
 
         #best_child = self.tree.root.children[np.argmax([node.nqueries for node in self.tree.root.children])]
-        best_child = random.choice([node for node in self.tree.root.children if node.nqueries == max([n.nqueries for n in self.tree.root.children])])
+        nqueries, _ = self.tree.root.child_stats()
+        best_child = self.tree.root.children[random.choice(np.flatnonzero(nqueries == nqueries.max()))]
+        self.best_child = best_child
         all_vals = {}
         for i, child in enumerate(self.tree.root.children):
-            all_vals[i] = child.reward / float(child.nqueries)
+            all_vals[i] = child.reward / float(max(child.nqueries, 1))
 
         paths, dense_paths = self.path_generator.get_path_set(self.cp)
-        return best_child.action, best_child.dense_path, best_child.reward/float(best_child.nqueries), paths, all_vals, self.max_locs, self.max_val, self.target
+        return best_child.action, best_child.dense_path, best_child.reward/float(max(best_child.nqueries, 1)), paths, all_vals, self.max_locs, self.max_val, self.target
 
         # get the best action to take with most promising futures, base best on whether to
         # consider cost
@@ -722,3 +1614,297 @@ class cMCTS(MCTS):
         #np.save('./figures/' + self.f_rew + '/tree_' + str(t) + '.npy', self.tree)
         #return self.tree[best_sequence][0], self.tree[best_sequence][1], best_val, paths, all_vals, self.max_locs, self.max_val
 
+
+    def record_returns(self, returns):
+        ''' Accumulates the returns of finished iterations '''
+        self.returns[0] += len(returns)
+        self.returns[1] += np.sum(returns)
+        self.returns[2] += np.sum(np.square(returns))
+
+    def keep_searching(self, i, time_start):
+        '''
+        Extends MCTS.keep_searching with early termination: if a convergence confidence is set, the search is
+        stopped (after min_iterations) as soon as converged reports that the root decision is settled.
+        '''
+        if not super(cMCTS, self).keep_searching(i, time_start):
+            return False
+        if self.convergence_confidence is not None and i >= max(self.min_iterations, self.next_check):
+            self.next_check = i + self.convergence_interval
+            if self.converged(i):
+                print "Search converged after", i, "iterations"
+                logger.info("Search converged after {} iterations".format(i))
+                return False
+        return True
+
+    def converged(self, i):
+        '''
+        Decides whether more iterations can still change the selected root action, i.e. the most visited root
+        child. This is settled if its lead in visits exceeds the iterations left in the budget, or if the lower
+        confidence bound of its value exceeds the upper bounds of all other children. The bounds are
+        convergence_confidence standard errors wide, using the spread of the returns of all iterations so far.
+        Inputs:
+            i (int) number of iterations run so far
+        '''
+        if self.tree.root.children is None:
+            return False
+        if len(self.tree.root.children) == 1:
+            return True
+        nqueries, reward = self.tree.root.child_stats()
+        order = np.argsort(nqueries)
+        best = order[-1]
+        if self.deadline is None and nqueries[best] - nqueries[order[-2]] > self.comp_budget - i:
+            return True
+        # Ties in visits are broken at random, so the confidence test needs a strict leader
+        if self.returns[0] < 2 or np.any(nqueries == 0) or nqueries[best] == nqueries[order[-2]]:
+            return False
+
+        n, total, squares = self.returns
+        sigma = np.sqrt(max(squares / n - (total / n) ** 2, 0.0))
+        values = reward / nqueries
+        bounds = self.convergence_confidence * sigma / np.sqrt(nqueries)
+        others = np.arange(len(nqueries)) != best
+        return values[best] - bounds[best] > np.max(values[others] + bounds[others])
+
+    def root_parallel_search(self, time_start):
+        '''
+        Root-parallel tree search: the computation budget is split over n_workers independent copies of the
+        unexpanded tree, each grown in its own process from the same belief snapshot, and the statistics of
+        the root children are summed into self.tree before the best action is selected. In deadline mode,
+        min_iterations is split instead and every worker searches until the shared deadline.
+        Inputs:
+            time_start (float) wall-clock time at which the search started
+        Outputs:
+            iterations (int) the total number of rollouts performed by all workers
+        '''
+        if self.deadline is None:
+            budget, deadline = self.comp_budget, None
+            n_workers = min(self.n_workers, budget)
+        else:
+            budget, deadline = self.min_iterations, time_start + self.deadline
+            n_workers = self.n_workers
+        iterations = [budget / n_workers + (1 if k < budget % n_workers else 0) for k in xrange(n_workers)]
+
+        # The root children are generated deterministically from the root pose, so workers agree on their order
+        if self.tree.root.children is None:
+            self.tree.build_action_children(self.tree.root)
+        # Statistics already in the tree (e.g. a reused subtree) are copied to every worker and counted once
+        if self.tree.root.children is not None:
+            prior = [(child.nqueries, child.reward) for child in self.tree.root.children]
+        seeds = np.random.randint(0, 2**31 - 1, size = n_workers)
+        jobs = [(self.tree, self.GP, iterations[k], seeds[k], self.batch_size, deadline, self.collect_stats) for k in xrange(n_workers)]
+
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            results = pool.map(root_parallel_worker, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        total = sum([n for n, stats, search_stats in results])
+        for n, stats, search_stats in results:
+            if search_stats is not None and self.stats is not None:
+                self.stats.merge(search_stats)
+        if self.tree.root.children is None:
+            return total
+        for n, stats, search_stats in results:
+            if stats is None:
+                continue
+            for child, (nqueries, reward), (nqueries_prior, reward_prior) in zip(self.tree.root.children, stats, prior):
+                child.nqueries += nqueries - nqueries_prior
+                child.reward += reward - reward_prior
+                self.tree.root.nqueries += nqueries - nqueries_prior
+                self.tree.root.reward += reward - reward_prior
+        return total
+
+    def reroot(self, zobs):
+        '''
+        After the selected action has been executed, detaches the part of its subtree that stays relevant so
+        that it can seed the next planning step. The new root is the belief child of the action whose simulated
+        observations best match the collected ones; in a 'belief' tree all belief children carry the maximum
+        likelihood observation, so the most visited one is kept. Siblings are pruned and depths shifted so
+        that the new root is at depth 0.
+        Inputs:
+            zobs (float array) the observations collected along the executed action
+        Outputs:
+            root (Node) the new root, or None if the executed action has no belief children
+        '''
+        if self.best_child is None or self.best_child.children is None:
+            return None
+
+        children = self.best_child.children
+        if self.tree_type == 'belief':
+            root = children[np.argmax(self.best_child.child_stats()[0])]
+        else:
+            root = children[np.argmin([np.linalg.norm(np.ravel(self.tree.child_zvals(self.best_child, child)) - np.ravel(zobs)) for child in children])]
+
+        root.detach()
+        return root
+
+class ExhaustivePlanner(cMCTS):
+    '''
+    Planner that scores every action sequence up to the rollout length instead of sampling them, which is
+    cheaper than MCTS for short horizons. The belief of each shared prefix is conditioned once, on the
+    maximum likelihood observations of its actions, and all actions that continue the prefix are scored with
+    one stacked aquisition call. The first action of the best sequence is returned, so the choice is
+    deterministic up to ties.
+    '''
+    def __init__(self, computation_budget, belief, initial_pose, rollout_length, path_generator, aquisition_function, f_rew, T, aq_param = None, use_cost = False, max_val_sampler = None, raster_resolution = None, collect_stats = False, max_val_workers = None):
+        # The computation budget is not used; all sequences are scored
+        super(ExhaustivePlanner, self).__init__(computation_budget, belief, initial_pose, rollout_length, path_generator, aquisition_function, f_rew, T, aq_param = aq_param, use_cost = use_cost, tree_type = 'exhaustive', max_val_sampler = max_val_sampler, raster_resolution = raster_resolution, collect_stats = collect_stats, max_val_workers = max_val_workers)
+
+    def choose_trajectory(self, t):
+        param, raster = self.search_param(t)
+        # The tree enumerates the sequences and holds the value of the best sequence through each action
+        self.tree = Tree(self.f_rew, self.aquisition_function, self.GP, self.cp, self.path_generator, t, depth = self.rl, param = param, c = self.c, raster = raster)
+        if self.collect_stats:
+            self.stats = SearchStats()
+            self.stats.instrument(self.tree, self.GP)
+
+        time_start = time.time()
+        value, self.iterations = self.sequence_value(self.tree.root, self.GP)
+        time_end = time.time()
+        print "Scored", self.iterations, "sequences in", str(time_end - time_start) + "s"
+        logger.info("Scored {} sequences in {}s".format(self.iterations, time_end - time_start))
+        if self.stats is not None:
+            self.stats.release(self.tree, self.GP)
+            self.stats.add_tree(self.tree)
+            self.stats.iterations = self.iterations
+            self.stats.search_time = time_end - time_start
+            self.stats.report()
+
+        if self.tree.root.children is None:
+            self.tree.build_action_children(self.tree.root)
+        _, values = self.tree.root.child_stats()
+        best_child = self.tree.root.children[random.choice(np.flatnonzero(values == values.max()))]
+        self.best_child = best_child
+        all_vals = {}
+        for i, child in enumerate(self.tree.root.children):
+            all_vals[i] = child.reward
+
+        paths, dense_paths = self.path_generator.get_path_set(self.cp)
+        return best_child.action, best_child.dense_path, best_child.reward, paths, all_vals, self.max_locs, self.max_val, self.target
+
+    def sequence_value(self, node, belief):
+        '''
+        Scores the actions of a belief node and, recursively, the sequences that continue them. The reward of
+        each action node is set to the value of the best sequence through it.
+        Inputs:
+            node (Node) a belief node
+            belief (GP model) the belief at the node; it is not modified
+        Outputs:
+            value (float) the value of the best sequence from the node
+            count (int) the number of sequences scored
+        '''
+        if node.depth == self.rl:
+            return 0.0, 1
+        if node.children is None:
+            self.tree.build_action_children(node)
+        # If no viable actions are avaliable
+        if node.children is None:
+            return 0.0, 1
+
+        xobs = [self.tree.path_observations(child) for child in node.children]
+        rewards = self.tree.batch_path_reward(xobs, belief, node.depth)
+        count = 0
+        for child, obs, r in zip(node.children, xobs, rewards):
+            value, n = 0.0, 1
+            if node.depth + 1 < self.rl:
+                zobs, _ = belief.predict_value(obs)
+                child_belief = self.tree.observe(belief, obs, zobs, node.depth)
+                belief_node, _ = self.tree.add_belief_child(child, zobs)
+                value, n = self.sequence_value(belief_node, child_belief)
+            child.nqueries = 1
+            child.reward = r + value
+            count += n
+
+        _, values = node.child_stats()
+        node.nqueries = 1
+        node.reward = values.max()
+        return node.reward, count
+
+    def reroot(self, zobs):
+        ''' Every step scores all sequences from scratch, so there is no subtree to carry over '''
+        return None
+
+class LazyGreedyPlanner(cMCTS):
+    '''
+    Multi-step planner for the submodular info_gain reward. Every action avaliable at the robot pose is
+    completed greedily into a sequence of rollout_length actions, and the first action of the best sequence is
+    returned. The greedy steps are lazy (CELF): the candidate actions are kept in a priority queue by an upper
+    bound of their marginal gain (see info_gain_bounds), and only the top of the queue is evaluated exactly,
+    until an exact gain tops the queue.
+    '''
+    def __init__(self, computation_budget, belief, initial_pose, rollout_length, path_generator, aquisition_function, f_rew, T, aq_param = None, use_cost = False):
+        if f_rew != 'info_gain':
+            raise ValueError('The lazy greedy planner requires the submodular \'info_gain\' reward')
+        # The computation budget is not used; the number of aquisition evaluations follows from the laziness
+        super(LazyGreedyPlanner, self).__init__(computation_budget, belief, initial_pose, rollout_length, path_generator, aquisition_function, f_rew, T, aq_param = aq_param, use_cost = use_cost, tree_type = 'lazy_greedy')
+        self.evaluations = 0
+
+    def gain(self, t, xobs, belief):
+        ''' The exact marginal gain of observing xobs given the observations of the belief '''
+        self.evaluations += 1
+        return self.aquisition_function(time = t, xvals = xobs, robot_model = belief)
+
+    def path_observations(self, path):
+        obs = np.array(path)
+        return np.vstack([obs[:,0], obs[:,1]]).T
+
+    def lazy_greedy_step(self, t, pose, belief):
+        '''
+        Selects the action of largest marginal gain from a pose
+        Outputs:
+            (key, gain, path, dense_path) of the selected action, or None if no actions are avaliable
+        '''
+        actions, dense_paths = self.path_generator.get_path_set(pose)
+        if len(actions) == 0:
+            return None
+        keys = actions.keys()
+        xobs = [self.path_observations(actions[key]) for key in keys]
+        bounds = info_gain_bounds(t, xobs, belief)
+
+        # Entries are (-bound, index, exact); an exact gain at the top is at least every remaining bound
+        queue = [(-bound, i, False) for i, bound in enumerate(bounds)]
+        heapq.heapify(queue)
+        while True:
+            bound, i, exact = heapq.heappop(queue)
+            if exact:
+                return keys[i], -bound, actions[keys[i]], dense_paths[keys[i]]
+            heapq.heappush(queue, (-self.gain(t, xobs[i], belief), i, True))
+
+    def greedy_value(self, t, xobs, dense_path, belief):
+        ''' The gain of an action followed by a greedy completion to rollout_length actions '''
+        value = self.gain(t, xobs, belief)
+        pose = dense_path[-1]
+        for depth in xrange(1, self.rl):
+            # The information gain does not depend on the observed values
+            belief = copy.copy(belief)
+            belief.add_data(xobs, np.zeros((xobs.shape[0], 1)))
+            step = self.lazy_greedy_step(t, pose, belief)
+            if step is None:
+                break
+            key, gain, path, dense_path = step
+            value += gain
+            xobs, pose = self.path_observations(path), dense_path[-1]
+        return value
+
+    def choose_trajectory(self, t):
+        param, raster = self.search_param(t)
+        time_start = time.time()
+        paths, dense_paths = self.path_generator.get_path_set(self.cp)
+        keys = paths.keys()
+        all_vals = {}
+        for i, key in enumerate(keys):
+            all_vals[i] = self.greedy_value(t, self.path_observations(paths[key]), dense_paths[key], self.GP)
+        time_end = time.time()
+        self.iterations = self.evaluations
+        print "Planned with", self.evaluations, "aquisition evaluations in", str(time_end - time_start) + "s"
+        logger.info("Planned with {} aquisition evaluations in {}s".format(self.evaluations, time_end - time_start))
+
+        values = np.array([all_vals[i] for i in xrange(len(keys))])
+        best = random.choice(np.flatnonzero(values == values.max()))
+        return paths[keys[best]], dense_paths[keys[best]], all_vals[best], paths, all_vals, self.max_locs, self.max_val, self.target
+
+    def reroot(self, zobs):
+        ''' The planner keeps no tree between steps '''
+        return None
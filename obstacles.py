@@ -13,6 +13,116 @@ from shapely.geometry import Polygon, Point
 import matplotlib
 import matplotlib.pyplot as plt
 
+# Number of blocks above which a BlockWorld answers batch queries through a GridIndex
+GRID_INDEX_BLOCKS = 16
+
+def as_points(points):
+	'''
+	Returns points, a sequence of n points (and possibly headings), as an n x 2 or more array of floats
+	'''
+	points = np.asarray(points, dtype=float)
+	if points.size == 0:
+		return np.zeros((len(points), 2))
+	return points.reshape(len(points), -1)
+
+def boxes_contain(bounds, points, buff):
+	'''
+	Tests points against buffered boxes, with the same strict inequalities as BlockWorld.in_obstacle
+	Input: bounds (array of boxes as (xmin, xmax, ymin, ymax) along the last axis, broadcast against the points), points (n x 2 or more array), buff (float)
+	Output: array of booleans with the broadcast shape, the points along the first axis
+	'''
+	x = points[:, 0].reshape((-1,) + (1,) * (bounds.ndim - 2))
+	y = points[:, 1].reshape((-1,) + (1,) * (bounds.ndim - 2))
+	return (x > bounds[..., 0]-buff) & (x < bounds[..., 1]+buff) & (y > bounds[..., 2]-buff) & (y < bounds[..., 3]+buff)
+
+def boxes_distance(bounds, points):
+	'''
+	Signed Chebyshev distance of points to a union of boxes; a point is inside of the boxes grown by buff, as tested by boxes_contain, exactly when its distance is below buff
+	Input: bounds (m x 4 array of boxes as (xmin, xmax, ymin, ymax)), points (n x 2 or more array)
+	Output: array of n distances, inf if there are no boxes
+	'''
+	distance = np.full(len(points), np.inf)
+	for box in bounds:
+		distance = np.minimum(distance, np.maximum(np.maximum(box[0] - points[:, 0], points[:, 0] - box[1]), np.maximum(box[2] - points[:, 1], points[:, 1] - box[3])))
+	return distance
+
+class DistanceField():
+	'''
+	Raster of the signed Chebyshev distance to a union of boxes at the nodes of a regular grid over the extent. The distance changes by at most half the resolution
+	between a point and its nearest node, so a lookup decides whether a point is inside of the boxes grown by any buffer, except for points within half the resolution
+	of the grown boundary, or outside of the extent, which are reported as uncertain to be checked exactly.
+	'''
+
+	def __init__(self, bounds, extent, resolution):
+		'''
+		Input: bounds (m x 4 array of boxes as (xmin, xmax, ymin, ymax)), extent (list of floats, range of the raster), resolution (float, spacing of the nodes)
+		'''
+		self.extent = extent
+		self.resolution = float(resolution)
+		self.shape = (int(np.ceil((extent[1] - extent[0]) / self.resolution)) + 1, int(np.ceil((extent[3] - extent[2]) / self.resolution)) + 1)
+		x, y = np.meshgrid(extent[0] + self.resolution * np.arange(self.shape[0]), extent[2] + self.resolution * np.arange(self.shape[1]), indexing='ij')
+		self.distance = boxes_distance(bounds, np.vstack([x.ravel(), y.ravel()]).T).reshape(self.shape)
+
+		# Slack for rounding in the lookup
+		self.margin = 0.5 * self.resolution * (1. + 1e-9) + 1e-12
+
+	def query(self, points, buff):
+		'''
+		Looks up the points in the raster
+		Input: points (n x 2 or more array), buff (float)
+		Output: inside (n booleans, whether each point is inside of the grown boxes), uncertain (n booleans, whether the lookup does not decide)
+		'''
+		i = np.rint((points[:, 0] - self.extent[0]) / self.resolution)
+		j = np.rint((points[:, 1] - self.extent[2]) / self.resolution)
+		outside = (i < 0) | (i >= self.shape[0]) | (j < 0) | (j >= self.shape[1]) | np.isnan(i) | np.isnan(j)
+		i = np.where(outside, 0, i).astype(int)
+		j = np.where(outside, 0, j).astype(int)
+		distance = self.distance[i, j]
+		return distance < buff - self.margin, outside | (np.abs(distance - buff) <= self.margin)
+
+class GridIndex():
+	'''
+	Uniform grid of buckets over a set of boxes. Each box is registered in every cell that it overlaps once grown by
+	the cell size, so the boxes that a point can hit with a buffer of at most the cell size are all in its own cell.
+	'''
+
+	def __init__(self, bounds, cell_size):
+		'''
+		Input: bounds (n x 4 array of boxes as (xmin, xmax, ymin, ymax)), cell_size (float, side of the cells)
+		'''
+		self.bounds = bounds
+		self.cell_size = float(cell_size)
+		self.origin = (bounds[:, 0].min() - self.cell_size, bounds[:, 2].min() - self.cell_size)
+		self.shape = (int(np.ceil((bounds[:, 1].max() - self.origin[0]) / self.cell_size)) + 2,
+		              int(np.ceil((bounds[:, 3].max() - self.origin[1]) / self.cell_size)) + 2)
+
+		buckets = [[] for i in range(self.shape[0] * self.shape[1])]
+		for k, (xmin, xmax, ymin, ymax) in enumerate(bounds):
+			i0, j0 = self.cell(xmin - self.cell_size, ymin - self.cell_size)
+			i1, j1 = self.cell(xmax + self.cell_size, ymax + self.cell_size)
+			for i in range(i0, i1 + 1):
+				for j in range(j0, j1 + 1):
+					buckets[i * self.shape[1] + j].append(k)
+
+		# Buckets are padded to a rectangular array of box ids; the padding points to an empty box that contains nothing
+		width = max(len(bucket) for bucket in buckets)
+		self.buckets = np.full((len(buckets), width), len(bounds), dtype=int)
+		for c, bucket in enumerate(buckets):
+			self.buckets[c, :len(bucket)] = bucket
+		self.padded = np.vstack([bounds, [np.inf, -np.inf, np.inf, -np.inf]])
+
+	def cell(self, x, y):
+		''' Returns the (clipped) cell indices of coordinates '''
+		i = np.clip(np.floor((x - self.origin[0]) / self.cell_size).astype(int), 0, self.shape[0] - 1)
+		j = np.clip(np.floor((y - self.origin[1]) / self.cell_size).astype(int), 0, self.shape[1] - 1)
+		return i, j
+
+	def query(self, points, buff):
+		''' Returns for each point whether it is inside of a box grown by buff, which must be at most the cell size '''
+		i, j = self.cell(points[:, 0], points[:, 1])
+		candidates = self.padded[self.buckets[i * self.shape[1] + j]]
+		return boxes_contain(candidates, points, buff).any(axis=1)
+
 class FreeWorld():
 	def __init__(self):
 		self.obstacles = []
@@ -20,6 +130,18 @@ class FreeWorld():
 	def in_obstacle(self, point, buff=0.1):
 		return False
 
+	def in_obstacle_batch(self, points, buff=0.1):
+		'''
+		Vectorized in_obstacle; points is an array of n points (and possibly headings), returns n booleans
+		'''
+		return np.zeros(len(points), dtype=bool)
+
+	def boundary_lines(self, buff=0.1):
+		'''
+		Vertical and horizontal lines, as arrays of x and y coordinates, between which in_obstacle with buffer buff does not change
+		'''
+		return np.array([]), np.array([])
+
 	def get_obstacles(self):
 		return []
 
@@ -28,9 +150,9 @@ class BlockWorld():
 	This class allows for the initialization of n blocks of mxp dimensions in the environment of interest either placed randomly or at provided locations.
 	'''
 
-	def __init__(self, extent, num_blocks=1, dim_blocks=(2.,2.), centers=None):
+	def __init__(self, extent, num_blocks=1, dim_blocks=(2.,2.), centers=None, field_resolution=None):
 		'''
-		Input: extent (list of floats, range of the environment); num_blocks (int, number of blocks to generate in the world), dim_blocks (tuple of floats, size of the obstacle to be created), centers (tuple of list of tuples of floats, locations to place bocks; if none, they will be placed randomly)
+		Input: extent (list of floats, range of the environment); num_blocks (int, number of blocks to generate in the world), dim_blocks (tuple of floats, size of the obstacle to be created), centers (tuple of list of tuples of floats, locations to place bocks; if none, they will be placed randomly), field_resolution (float, resolution of a DistanceField answering in_obstacle_batch; if none, no field is built)
 		'''
 
 		self.extent = extent
@@ -54,6 +176,14 @@ class BlockWorld():
 			self.obstacles.append(Polygon(points))
 			self.points.append(points)
 
+		# Bounds of the blocks as rows of (xmin, xmax, ymin, ymax), and a grid index for worlds with many blocks
+		self.bounds = np.array([(obs[2][0], obs[0][0], obs[1][1], obs[0][1]) for obs in self.points]).reshape(-1, 4)
+		self.index = None
+		if len(self.bounds) > GRID_INDEX_BLOCKS:
+			self.index = GridIndex(self.bounds, max(dim_blocks))
+		self.field = None
+		if field_resolution is not None:
+			self.field = DistanceField(self.bounds, extent, field_resolution)
 
 	def in_obstacle(self, point, buff=0.1):
 		'''
@@ -74,6 +204,34 @@ class BlockWorld():
 					return True
 		return False
 
+	def in_obstacle_batch(self, points, buff=0.1):
+		'''
+		Vectorized in_obstacle; points is an array of n points (and possibly headings), returns n booleans
+		'''
+		points = as_points(points)
+		if self.field is None:
+			return self.in_boxes(points, buff)
+		inside, uncertain = self.field.query(points, buff)
+		if uncertain.any():
+			inside[uncertain] = self.in_boxes(points[uncertain], buff)
+		return inside
+
+	def boundary_lines(self, buff=0.1):
+		'''
+		Vertical and horizontal lines, as arrays of x and y coordinates, between which in_obstacle with buffer buff does not change
+		'''
+		xs = np.concatenate([self.bounds[:, 0] - buff, self.bounds[:, 1] + buff])
+		ys = np.concatenate([self.bounds[:, 2] - buff, self.bounds[:, 3] + buff])
+		return xs[np.isfinite(xs)], ys[np.isfinite(ys)]
+
+	def in_boxes(self, points, buff):
+		'''
+		Exact test of an array of points against the buffered blocks, through the grid index if there is one
+		'''
+		if self.index is not None and buff <= self.index.cell_size:
+			return self.index.query(points, buff)
+		return boxes_contain(self.bounds[np.newaxis, :, :], points, buff).any(axis=1)
+
 
 
 
@@ -103,7 +261,8 @@ class BlockWorld():
 
 class BugTrap(BlockWorld):
 	'''
-	Class to generate a typical bugtrap environment
+	Class to generate a typical bugtrap environment. Its buffered test moves the opening of the trap rather than growing the walls, so it is not a distance threshold and the
+	bugtrap has no DistanceField.
 	'''
 
 	def __init__(self, extent, opening_location, opening_size, channel_size = 0.5, width = 3., orientation='left'):
@@ -161,12 +320,37 @@ class BugTrap(BlockWorld):
 					return True
 			return False
 
+	def in_obstacle_batch(self, points, buff=0.1):
+		'''
+		Vectorized in_obstacle; points is an array of n points (and possibly headings), returns n booleans
+		'''
+		points = as_points(points)
+		x, y = points[:, 0], points[:, 1]
+		outer = (x > self.outer_xlim[0]-buff) & (x < self.outer_xlim[1]+buff) & (y < self.outer_ylim[0]+buff) & (y > self.outer_ylim[1]-buff)
+		if self.orientation == 'left':
+			inner = (x >= self.inner_xlim[0]-buff) & (x <= self.inner_xlim[1]-buff)
+		elif self.orientation == 'right':
+			inner = (x >= self.inner_xlim[0]+buff) & (x <= self.inner_xlim[1]+buff)
+		else:
+			return np.zeros(len(points), dtype=bool)
+		inner &= (y <= self.inner_ylim[0]-buff) & (y >= self.inner_ylim[1]+buff)
+		return outer & ~inner
+
+	def boundary_lines(self, buff=0.1):
+		'''
+		Vertical and horizontal lines, as arrays of x and y coordinates, between which in_obstacle with buffer buff does not change
+		'''
+		shift = -buff if self.orientation == 'left' else buff
+		xs = np.array([self.outer_xlim[0]-buff, self.outer_xlim[1]+buff, self.inner_xlim[0]+shift, self.inner_xlim[1]+shift])
+		ys = np.array([self.outer_ylim[0]+buff, self.outer_ylim[1]-buff, self.inner_ylim[0]-buff, self.inner_ylim[1]+buff])
+		return xs, ys
+
 class ChannelWorld(BlockWorld):
 	'''
 	Class to generate an environment that is divided with a single hallway for entering
 	'''
 
-	def __init__(self, extent, opening_location, opening_size, wall_thickness):
+	def __init__(self, extent, opening_location, opening_size, wall_thickness, field_resolution=None):
 		self.extent = extent
 		self.opening_location = opening_location
 		self.opening_size = opening_size
@@ -188,6 +372,13 @@ class ChannelWorld(BlockWorld):
 		self.xlim = [opening_location[0]-wall_thickness/2, opening_location[0]+wall_thickness/2]
 		self.ylim = [opening_location[1]-opening_size/2, opening_location[1]+opening_size/2]
 
+		# The walls as boxes for the batch queries of BlockWorld; in_obstacle does not bound them by the extent
+		self.bounds = np.array([(self.xlim[0], self.xlim[1], -np.inf, self.ylim[0]), (self.xlim[0], self.xlim[1], self.ylim[1], np.inf)])
+		self.index = None
+		self.field = None
+		if field_resolution is not None:
+			self.field = DistanceField(self.bounds, extent, field_resolution)
+
 	def in_obstacle(self, point, buff=0.1):
 		if point[0] > self.xlim[0]-buff and point[0] < self.xlim[1]+buff:
 			if point[1] < self.ylim[0]+buff or point[1] > self.ylim[1]-buff:
@@ -14,6 +14,107 @@ import dubins
 import obstacles as obs
 import pdb
 import matplotlib.pyplot as plt
+from collections import OrderedDict
+
+# Steering of the three segments of each type of Dubins path: 1 turns left, 0 goes straight and -1 turns right
+DUBINS_STEERING = {dubins.LSL: (1, 0, 1), dubins.LSR: (1, 0, -1), dubins.RSL: (-1, 0, 1),
+                   dubins.RSR: (-1, 0, -1), dubins.RLR: (-1, 1, -1), dubins.LRL: (1, -1, 1)}
+
+def dubins_segments(path):
+    '''
+    Splits a Dubins path into its three segments
+    Input: path (dubins path)
+    Output:
+        poses (3 x 3 array) start configuration of each segment
+        steering (3 ints) the steering of each segment, as in DUBINS_STEERING
+        lengths (3 floats) arc length of each segment
+    '''
+    lengths = np.array([path.segment_length(i) for i in range(3)])
+    poses = np.array([path.sample(s) for s in np.cumsum(lengths) - lengths])
+    return poses, np.array(DUBINS_STEERING[path.path_type()]), lengths
+
+def segment_collisions(poses, steering, lengths, radius, extent, obstacle_world, buff):
+    '''
+    Finds the arc length at which each of a set of straight and circular segments first leaves the extent or enters an
+    obstacle grown by buff. The segments are cut at their crossings with the boundary of the extent and with the boundary
+    lines of the obstacle world, between which they are either free or not, and each piece is checked at its midpoint.
+    Only the lines within the bounding box of a segment are intersected with it.
+    Input:
+        poses (n x 3 array) start configuration of each segment
+        steering (n ints) 1 for a left turn, 0 for a straight segment and -1 for a right turn
+        lengths (n floats) arc length of each segment
+        radius (float) turning radius of the circular segments
+        extent (list of floats) the world boundaries; a segment leaves the world at its first point not strictly inside
+        obstacle_world (obstacle world) the obstacles, answering in_obstacle_batch and boundary_lines
+        buff (float) the buffer around the obstacles
+    Output: n arc lengths, inf for the segments that stay free
+    '''
+    n = len(poses)
+    x0, y0, h = poses[:, 0], poses[:, 1], poses[:, 2]
+    k = np.asarray(steering, dtype = float)
+    L = np.asarray(lengths, dtype = float)
+    turning = k != 0
+
+    # Turns are parameterized by the angle of the vehicle around the center of their circle
+    cx, cy = x0 - k * radius * np.sin(h), y0 + k * radius * np.cos(h)
+    phi = h - k * np.pi / 2
+
+    # Bounding boxes of the segments: the whole circle of a turn, the end points of a straight segment
+    xe, ye = x0 + L * np.cos(h), y0 + L * np.sin(h)
+    boxes = [(np.where(turning, cx - radius, np.minimum(x0, xe)), np.where(turning, cx + radius, np.maximum(x0, xe))),
+             (np.where(turning, cy - radius, np.minimum(y0, ye)), np.where(turning, cy + radius, np.maximum(y0, ye)))]
+
+    # Nothing changes within a box crossed by no line, so if no line crosses the box around all segments they are either
+    # all free or all blocked from their start
+    xs, ys = obstacle_world.boundary_lines(buff)
+    xs, ys = np.concatenate([extent[0:2], xs]), np.concatenate([extent[2:4], ys])
+    if n > 0 and not (((xs >= boxes[0][0].min()) & (xs <= boxes[0][1].max())).any() or ((ys >= boxes[1][0].min()) & (ys <= boxes[1][1].max())).any()):
+        inside = x0[0] > extent[0] and x0[0] < extent[1] and y0[0] > extent[2] and y0[0] < extent[3]
+        if inside and not obstacle_world.in_obstacle_batch(poses[:1], buff = buff)[0]:
+            return np.full(n, np.inf)
+        return np.zeros(n)
+
+    # Pairs of segments and arc lengths at which they are cut, starting with the ends of the segments
+    segs = [np.arange(n), np.arange(n)]
+    cuts = [np.zeros(n), L]
+    for axis, lines in enumerate([xs, ys]):
+        lines = np.sort(lines)
+        first = np.searchsorted(lines, boxes[axis][0])
+        counts = np.searchsorted(lines, boxes[axis][1], side = 'right') - first
+        seg = np.repeat(np.arange(n), counts)
+        line = lines[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)]
+        t = turning[seg]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            if axis == 0:
+                straight = (line - x0[seg]) / np.cos(h[seg])
+                a = np.arccos(np.clip((line - cx[seg]) / radius, -1, 1))
+                angles = [a, -a]
+            else:
+                straight = (line - y0[seg]) / np.sin(h[seg])
+                b = np.arcsin(np.clip((line - cy[seg]) / radius, -1, 1))
+                angles = [b, np.pi - b]
+        segs += [seg[~t], seg[t], seg[t]]
+        cuts += [straight[~t]] + [radius * np.mod(k[seg[t]] * (angle[t] - phi[seg[t]]), 2 * np.pi) for angle in angles]
+
+    seg, s = np.concatenate(segs), np.concatenate(cuts)
+    valid = (s >= 0) & (s <= L[seg])
+    seg, s = seg[valid], s[valid]
+    order = np.lexsort((s, seg))
+    seg, s = seg[order], s[order]
+
+    # The pieces between consecutive cuts of a segment, checked at their midpoints
+    piece = (seg[1:] == seg[:-1]) & (s[1:] > s[:-1])
+    pseg, start = seg[:-1][piece], s[:-1][piece]
+    mid = (start + s[1:][piece]) / 2
+    theta = phi[pseg] + k[pseg] * mid / radius
+    px = np.where(turning[pseg], cx[pseg] + radius * np.cos(theta), x0[pseg] + mid * np.cos(h[pseg]))
+    py = np.where(turning[pseg], cy[pseg] + radius * np.sin(theta), y0[pseg] + mid * np.sin(h[pseg]))
+    inside = (px > extent[0]) & (px < extent[1]) & (py > extent[2]) & (py < extent[3])
+    bad = ~inside | obstacle_world.in_obstacle_batch(np.vstack([px, py]).T, buff = buff)
+
+    hits = np.full(n, np.inf)
+    np.minimum.at(hits, pseg[bad], start[bad])
+    return hits
 
 class Path_Generator:    
     def __init__(self, frontier_size, horizon_length, turning_radius, sample_step, extent, obstacle_world=obs.FreeWorld()):
@@ -33,6 +134,10 @@ class Path_Generator:
         self.ss = sample_step
         self.extent = extent
 
+        # The headings of the frontier goals, fixed to 75% of the unit circle, ignoring points directly behind the vehicle;
+        # the frontier points and the Dubins primitives both index into these angles
+        self.frontier_angles = np.linspace(-2.35,2.35,self.fs)
+
         # Global variables
         self.goals = [] #The frontier coordinates
         self.samples = {} #The sample points which form the paths
@@ -43,11 +148,12 @@ class Path_Generator:
 
     def generate_frontier_points(self):
         '''From the frontier_size and horizon_length, generate the frontier points to goal'''
-        angle = np.linspace(-2.35,2.35,self.fs) #fix the possibilities to 75% of the unit circle, ignoring points directly behind the vehicle
+        angle = self.frontier_angles
         # angle = np.linspace(-1.20,1.20,self.fs) #fix the possibilities to 75% of the unit circle, ignoring points directly behind the vehicle
         # angle = np.linspace(-2.00,2.00,self.fs) #fix the possibilities to 75% of the unit circle, ignoring points directly behind the vehicle
         goals = []
-        for a in angle:
+        goal_ids = []
+        for j, a in enumerate(angle):
             x = self.hl*np.cos(self.cp[2]+a)+self.cp[0]
             # if x >= self.extent[1]-3*self.tr:
             #     pass
@@ -78,8 +184,12 @@ class Path_Generator:
             #     pass
             else:
                 goals.append((x,y,p))
+                goal_ids.append(j)
         goals.append(self.cp)
+        goal_ids.append(-1)
         self.goals = goals
+        # The index of each goal's angle on the frontier, or -1 for the current pose
+        self.goal_ids = goal_ids
         return self.goals
 
     def make_sample_paths(self):
@@ -143,34 +253,68 @@ class Dubins_Path_Generator(Path_Generator):
     The Dubins_Path_Generator class, which inherits from the Path_Generator class. Replaces the make_sample_paths
     method with paths generated using the dubins library
     '''
+    def __init__(self, frontier_size, horizon_length, turning_radius, sample_step, extent, obstacle_world=obs.FreeWorld()):
+        Path_Generator.__init__(self, frontier_size, horizon_length, turning_radius, sample_step, extent, obstacle_world)
+
+        # Dubins paths are invariant to rigid motions, so the paths to the frontier are sampled once in the
+        # frame of the vehicle and moved to each pose
+        self.primitives = None
+        self.primitive_offsets = None
+
+    def local_primitives(self):
+        '''
+        Samples the Dubins paths from the origin to each frontier goal in the frame of the vehicle, stacked into one
+        array with the offsets of each path; the last path is the one to the current pose
+        '''
+        if self.primitives is None:
+            goals = [(self.hl*np.cos(a), self.hl*np.sin(a), a) for a in self.frontier_angles] + [(0., 0., 0.)]
+            primitives = []
+            offsets = [0]
+            for goal in goals:
+                path = dubins.shortest_path((0., 0., 0.), goal, self.tr)
+                fconfig, _ = path.sample_many(self.ss/10)
+                primitives.append(np.array(fconfig).reshape(-1, 3))
+                offsets.append(offsets[-1] + len(fconfig))
+            self.primitives = np.vstack(primitives)
+            self.primitive_offsets = offsets
+        return self.primitives, self.primitive_offsets
     
     def buffered_paths(self):
+        primitives, offsets = self.local_primitives()
+
+        # Move all primitives to the current pose with one rotation and translation
+        c, s = np.cos(self.cp[2]), np.sin(self.cp[2])
+        x = self.cp[0] + c * primitives[:, 0] - s * primitives[:, 1]
+        y = self.cp[1] + s * primitives[:, 0] + c * primitives[:, 1]
+        heading = np.mod(primitives[:, 2] + self.cp[2], 2 * np.pi)
+        inside = (x > self.extent[0]) & (x < self.extent[1]) & (y > self.extent[2]) & (y < self.extent[3])
+        buffered = (x > self.extent[0]+3*self.tr) & (x < self.extent[1]-3*self.tr) & (y > self.extent[2]+3*self.tr) & (y < self.extent[3]-3*self.tr)
+        points = np.vstack([x, y]).T
+        inside &= ~self.obstacle_world.in_obstacle_batch(points, buff = 0.0)
+        buffered &= ~self.obstacle_world.in_obstacle_batch(points, buff = 3*self.tr)
+        configs = zip(x.tolist(), y.tolist(), heading.tolist())
+
         sampling_path = {}
         true_path = {}
-        for i,goal in enumerate(self.goals):            
-            path = dubins.shortest_path(self.cp, goal, self.tr)
-            fconfig, _ = path.sample_many(self.ss/10)
+        for i, j in enumerate(self.goal_ids):
+            # The path to the current pose is the last primitive
+            if j < 0:
+                j = len(offsets) - 2
+            start, end = offsets[j], offsets[j + 1]
 
-            ftemp = []
-            for c in fconfig:
-                if c[0] > self.extent[0] and c[0] < self.extent[1] and c[1] > self.extent[2] and c[1] < self.extent[3] and not self.obstacle_world.in_obstacle((c[0], c[1]), buff = 0.0):
-                    ftemp.append(c)
-                else:
-                    break
+            # Truncate the path at the first point outside of the world or inside of an obstacle
+            n = end - start if inside[start:end].all() else int(np.argmin(inside[start:end]))
 
-            try:
-                ttemp = ftemp[0::10]
-                for m,c in enumerate(ttemp):
-                    if c[0] <= self.extent[0]+3*self.tr or c[0] >= self.extent[1]-3*self.tr or c[1] <= self.extent[2]+3*self.tr or c[1] >= self.extent[3]-3*self.tr or self.obstacle_world.in_obstacle((c[0], c[1]), buff = 3*self.tr):
-                        ttemp = ttemp[0:m-1]
+            # Truncate the samples, taken every tenth point, before the first one too close to the boundary or an obstacle
+            nsamples = len(xrange(0, n, 10))
+            for m in np.flatnonzero(~buffered[start:start + n:10]):
+                nsamples = len(range(nsamples)[0:m-1])
 
-                if len(ttemp) < 2:
-                    pass
-                else:
-                    sampling_path[i] = ttemp
-                    true_path[i] = ftemp[0:ftemp.index(ttemp[-1])+1]
-            except:
+            if nsamples < 2:
                 pass
+            else:
+                sampling_path[i] = configs[start:start + 10*(nsamples-1) + 1:10]
+                true_path[i] = configs[start:start + 10*(nsamples-1) + 1]
 
         return sampling_path, true_path
 
@@ -203,7 +347,9 @@ class Dubins_EqualPath_Generator(Path_Generator):
             path = dubins.shortest_path(self.cp, goal, self.tr)
             configurations, _ = path.sample_many(self.ss)
             true_coords[i], _ = path.sample_many(self.ss/5)
-            coords[i] = [config for config in configurations if config[0] > self.extent[0] and config[0] < self.extent[1] and config[1] > self.extent[2] and config[1] < self.extent[3] and not self.obstacle_world.in_obstacle((config[0], config[1]), buff=self.tr)]
+            c = np.array(configurations).reshape(-1, 3)
+            free = (c[:, 0] > self.extent[0]) & (c[:, 0] < self.extent[1]) & (c[:, 1] > self.extent[2]) & (c[:, 1] < self.extent[3]) & ~self.obstacle_world.in_obstacle_batch(c, buff=self.tr)
+            coords[i] = [config for config, f in zip(configurations, free) if f]
         
         # find the "shortest" path in sample space
         current_min = 1000
@@ -252,6 +398,7 @@ class Reachable_Frontier_Generator():
         sampling_path = {}
         true_path = {}
 
+        paths = []
         for i,goal in enumerate(self.goals):
             dist = np.sqrt((loc[0]-goal[0])**2 + (loc[1]-goal[1])**2)
             if dist < self.step_size:
@@ -260,29 +407,42 @@ class Reachable_Frontier_Generator():
                 angle_to_goal = np.arctan2([goal[1]-loc[1]], [goal[0]-loc[0]])[0]
                 new_goal = (goal[0], goal[1], angle_to_goal)
 
-                path = dubins.shortest_path(loc, new_goal, self.turning_radius)
-                fconfig, _ = path.sample_many(self.sample_step/10)
+                paths.append((i, dubins.shortest_path(loc, new_goal, self.turning_radius)))
+
+        if len(paths) == 0:
+            return sampling_path, true_path
+
+        # Find where each path first leaves the world or comes too close to an obstacle from its segments
+        segments = [dubins_segments(path) for i, path in paths]
+        lengths = np.array([l for poses, steering, l in segments])
+        hits = segment_collisions(np.vstack([poses for poses, steering, l in segments]), np.concatenate([steering for poses, steering, l in segments]),
+                                  lengths.ravel(), self.turning_radius, self.ranges, self.obstacle_world, self.turning_radius)
+        truncation = np.min((np.cumsum(lengths, axis = 1) - lengths).ravel().reshape(-1, 3) + hits.reshape(-1, 3), axis = 1)
 
+        for (i, path), length in zip(paths, truncation):
+            # Only the part of the path before the truncation is sampled
+            if length <= 0:
                 ftemp = []
-                for c in fconfig:
-                    if c[0] > self.ranges[0] and c[0] < self.ranges[1] and c[1] > self.ranges[2] and c[1] < self.ranges[3] and not self.obstacle_world.in_obstacle((c[0], c[1]), buff = self.turning_radius):
-                        ftemp.append(c)
-                    else:
-                        break
+            else:
+                if length < path.path_length():
+                    path = path.extract_subpath(length)
+                ftemp, _ = path.sample_many(self.sample_step/10)
 
-                try:
-                    ttemp = ftemp[0::10]
-                    for m,c in enumerate(ttemp):
-                        if c[0] < self.ranges[0]+3*self.turning_radius or c[0] > self.ranges[1]-3*self.turning_radius or c[1] < self.ranges[2]+3*self.turning_radius or c[1] > self.ranges[3]-3*self.turning_radius or self.obstacle_world.in_obstacle((c[0], c[1]), buff = 3*self.turning_radius):
-                            ttemp = ttemp[0:m-1]
+            try:
+                ttemp = ftemp[0::10]
+                c = np.array(ttemp).reshape(-1, 3)
+                r = 3*self.turning_radius
+                unsafe = (c[:, 0] < self.ranges[0]+r) | (c[:, 0] > self.ranges[1]-r) | (c[:, 1] < self.ranges[2]+r) | (c[:, 1] > self.ranges[3]-r) | self.obstacle_world.in_obstacle_batch(c, buff = r)
+                for m in np.flatnonzero(unsafe):
+                    ttemp = ttemp[0:m-1]
 
-                    if len(ttemp) < 2:
-                        pass
-                    else:
-                        sampling_path[i] = ttemp
-                        true_path[i] = ftemp[0:ftemp.index(ttemp[-1])+1]
-                except:
+                if len(ttemp) < 2:
                     pass
+                else:
+                    sampling_path[i] = ttemp
+                    true_path[i] = ftemp[0:ftemp.index(ttemp[-1])+1]
+            except:
+                pass
 
         return sampling_path, true_path
 
@@ -313,6 +473,7 @@ class Reachable_Step_Generator(Reachable_Frontier_Generator):
         sampling_path = {}
         true_path = {}
 
+        steps = []
         for i,goal in enumerate(self.goals):
             dist = np.sqrt((loc[0]-goal[0])**2 + (loc[1]-goal[1])**2)
             angle_to_goal = np.arctan2([goal[1]-loc[1]], [goal[0]-loc[0]])[0]
@@ -326,13 +487,15 @@ class Reachable_Step_Generator(Reachable_Frontier_Generator):
             configurations, _ = path.sample_many(self.sample_step)
             configurations.append(new_goal)
             full_path = fconfig, _ = path.sample_many(self.sample_step/5)
+            steps.append((configurations, fconfig))
 
-            temp = []
-            for config in configurations:
-                if config[0] > self.ranges[0] and config[0] < self.ranges[1] and config[1] > self.ranges[2] and config[1] < self.ranges[3] and not self.obstacle_world.in_obstacle((config[0], config[1]), buff=self.turning_radius):
-                    temp.append(config)
-                else:
-                    break
+        # Check the configurations of all steps against the world in one batch
+        c = np.array([config[:3] for configurations, fconfig in steps for config in configurations]).reshape(-1, 3)
+        free = (c[:, 0] > self.ranges[0]) & (c[:, 0] < self.ranges[1]) & (c[:, 1] > self.ranges[2]) & (c[:, 1] < self.ranges[3]) & ~self.obstacle_world.in_obstacle_batch(c, buff=self.turning_radius)
+        splits = np.cumsum([len(configurations) for configurations, fconfig in steps])[:-1]
+
+        for i, ((configurations, fconfig), f) in enumerate(zip(steps, np.split(free, splits))):
+            temp = configurations if f.all() else configurations[:int(np.argmin(f))]
             if len(temp) < 2:
                 pass
             else:
@@ -353,6 +516,70 @@ class Reachable_Step_Generator(Reachable_Frontier_Generator):
 
         return sampling_path, true_path
 
+class Cached_Path_Generator(object):
+    '''
+    Wraps any of the path generators with a bounded least-recently-used cache of path sets, keyed by the pose
+    quantized to a resolution in position and heading, so that repeated expansions of the same pose are
+    dictionary lookups. The cached paths are stored as tuples so that they cannot be modified by callers.
+    '''
+    def __init__(self, path_generator, cache_size = 1000, resolution = 1e-4, heading_resolution = 1e-4):
+        ''' Initialize a cached path generator
+        Input:
+            path_generator (path generator object) the generator whose path sets are cached
+            cache_size (int) the maximum number of poses whose path sets are kept
+            resolution (float) the distance below which two positions share a cache entry
+            heading_resolution (float) the angle below which two headings share a cache entry
+        '''
+        self.path_generator = path_generator
+        self.cache_size = cache_size
+        self.resolution = resolution
+        self.heading_resolution = heading_resolution
+
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def pose_key(self, pose):
+        ''' Quantizes a pose of (x, y) or (x, y, heading) to a hashable cache key '''
+        key = (int(round(pose[0] / self.resolution)), int(round(pose[1] / self.resolution)))
+        if len(pose) > 2:
+            key += (int(round((pose[2] % (2 * np.pi)) / self.heading_resolution)),)
+        return key
+
+    def get_path_set(self, current_pose):
+        '''Primary interface for getting list of path sample points for evaluation
+        Input:
+            current_pose (tuple of x, y, z, a which are floats) current location of the robot in world coordinates
+        Output:
+            paths (dictionary of frontier keys and sample points)
+        '''
+        key = self.pose_key(current_pose)
+        if key in self.cache:
+            self.hits += 1
+            paths, true_paths = self.cache.pop(key)
+        else:
+            self.misses += 1
+            paths, true_paths = self.path_generator.get_path_set(current_pose)
+            paths = dict((k, tuple(tuple(c) for c in v)) for k, v in paths.items())
+            true_paths = dict((k, tuple(tuple(c) for c in v)) for k, v in true_paths.items())
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last = False)
+        # Reinserting the entry marks it as the most recently used
+        self.cache[key] = (paths, true_paths)
+        return dict(paths), dict(true_paths)
+
+    def clear(self):
+        ''' Empties the cache and resets the hit and miss counters '''
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # Everything else, e.g. path_cost, is answered by the wrapped generator
+        if name.startswith('__') or 'path_generator' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.path_generator, name)
+
 
 if __name__ == '__main__':
     # bw = obs.BlockWorld( [0., 10., 0., 10.], num_blocks=1, dim_blocks=(2.,2.), centers=[(6.1,5)])
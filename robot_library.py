@@ -53,7 +53,24 @@ class Robot(object):
             sample_set (float): the step size (in units of distance) between sequential samples on a trajectory
             evaluation (Evaluation object): an evaluation object for performance metric compuation
             f_rew (string): the reward function. One of {hotspot_info, mean, info_gain, exp_info, mes}
+            tree_type (string): the nonmyopic planner. One of {dpw, belief, exhaustive, lazy_greedy}; exhaustive scores every action sequence up to rollout_length, lazy_greedy completes each action greedily (info_gain only)
                     create_animation (boolean): save the generate world model and trajectory to file at each timestep 
+            warm_start_max_vals (boolean): carry the sampled max-values over between planning steps instead of resampling them (optional)
+            raster_resolution (int): if set, additive rewards of root-level paths are looked up in a raster of this resolution (optional)
+            mcts_workers (int): if greater than one, the MCTS budget is split over this many root-parallel worker processes (optional)
+            max_val_workers (int): if greater than one, the local searches of the max-value sampling ('mes', 'naive', 'naive_value') are spread over a pool of this many threads (optional)
+            mcts_batch_size (int): if set, the 'dpw' tree selects this many leaves per round and evaluates them in stacked GP calls (optional)
+            planning_deadline (float): if set, the MCTS runs for this many seconds per step instead of computation_budget iterations (optional)
+            min_iterations (int): the minimum number of MCTS iterations per step when planning_deadline is set (optional)
+            reuse_tree (boolean): carry the subtree of the executed action over to the next MCTS planning step (optional)
+            path_cache_size (int): if set, path sets are cached for up to this many recently expanded poses (optional)
+            memo_budget (int): if set, MCTS nodes memoize their rewards and, up to this many bytes, their beliefs (optional)
+            transposition_resolution (float): if set, MCTS belief nodes whose poses and observations agree up to this resolution are merged (optional)
+            surrogate_depth (int): if set, MCTS simulations stop conditioning the belief on observations of actions at or below this depth (optional)
+            search_stats (boolean): collect per-phase MCTS statistics at each step and record them with the evaluation metrics (optional)
+            convergence_confidence (float): if set, the MCTS stops once its root decision is settled at this many standard errors, and the unspent iterations are added to the budget of the following steps; only the 'dpw' and 'belief' tree types stop early (optional)
+            mission_budget (int): if set, the total number of MCTS iterations over the mission; a step never plans with more than what is left, and once it is spent the robot plans myopically; only avaliable for the 'dpw' and 'belief' tree types, and not with planning_deadline (optional)
+            value_depth (int): if set, 'belief' tree rollouts are truncated at this depth by a value estimator fitted online over the mission (optional)
         '''
 
         # Parameterization for the robot
@@ -80,6 +97,34 @@ class Robot(object):
         self.obstacle_world = kwargs['obstacle_world']
         self.learn_params = kwargs['learn_params']
         self.use_cost = kwargs['use_cost']
+        self.raster_resolution = kwargs.get('raster_resolution', None)
+        self.mcts_workers = kwargs.get('mcts_workers', None)
+        self.max_val_workers = kwargs.get('max_val_workers', None)
+        self.mcts_batch_size = kwargs.get('mcts_batch_size', None)
+        self.planning_deadline = kwargs.get('planning_deadline', None)
+        self.min_iterations = kwargs.get('min_iterations', 0)
+        self.reuse_tree = kwargs.get('reuse_tree', False)
+        self.memo_budget = kwargs.get('memo_budget', None)
+        self.transposition_resolution = kwargs.get('transposition_resolution', None)
+        self.surrogate_depth = kwargs.get('surrogate_depth', None)
+        self.search_stats = kwargs.get('search_stats', False)
+        self.convergence_confidence = kwargs.get('convergence_confidence', None)
+        self.mission_budget = kwargs.get('mission_budget', None)
+        if self.mission_budget is not None and self.planning_deadline is not None:
+            raise ValueError('A mission budget caps iterations, which are not counted in deadline mode')
+        # The exhaustive and lazy greedy planners count scored sequences and aquisition evaluations, not MCTS iterations
+        self.counts_iterations = self.tree_type in ['dpw', 'belief']
+        if self.mission_budget is not None and not self.counts_iterations:
+            raise ValueError('A mission budget caps MCTS iterations, and is only avaliable for the \'dpw\' and \'belief\' tree types')
+        # MCTS iterations spent so far, and those saved by early termination for later steps
+        self.iterations_used = 0
+        self.budget_bank = 0
+        # The value estimator is kept over the mission, so that it only warms up once
+        self.value_estimator = None
+        if kwargs.get('value_depth', None) is not None:
+            self.value_estimator = mctslib.ValueEstimator(depth = kwargs['value_depth'])
+        # Root of the subtree carried over from the previous planning step
+        self.mcts_root = None
         
         self.MIN_COLOR = kwargs['MIN_COLOR']
         self.MAX_COLOR = kwargs['MAX_COLOR']
@@ -115,6 +160,14 @@ class Robot(object):
         else:
             raise ValueError('Only \'hotspot_info\' and \'mean\' and \'info_gain\' and \'mes\' and \'exp_improve\' reward fucntions supported.')
 
+        # Optionally, keep the sampled max-values between planning steps and update them incrementally
+        self.max_val_sampler = None
+        if kwargs.get('warm_start_max_vals', False):
+            if self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
+                self.max_val_sampler = aqlib.MaxValueSampler(obstacles = self.obstacle_world, f_rew = self.f_rew, n_workers = self.max_val_workers)
+            elif self.f_rew == 'naive' or self.f_rew == 'naive_value':
+                self.max_val_sampler = aqlib.MaxValueSampler(nK = int(self.sample_num), obstacles = self.obstacle_world, f_rew = self.f_rew, n_workers = self.max_val_workers)
+
         # Initialize the robot's GP model with the initial kernel parameters
         self.GP = gplib.OnlineGPModel(ranges = self.ranges, lengthscale = kwargs['init_lengthscale'], variance = kwargs['init_variance'], noise = self.noise, dimension = self.dimension)
         # self.GP = gplib.GPModel(ranges = self.ranges, lengthscale = kwargs['init_lengthscale'], variance = kwargs['init_variance'], noise = self.noise, dimension = self.dimension)
@@ -150,6 +203,10 @@ class Robot(object):
         else:
             self.path_generator = pathlib.Path_Generator(self.frontier_size, self.horizon_length, self.turning_radius, self.sample_step, self.ranges, self.obstacle_world)
 
+        # If set, repeated expansions of the same pose reuse the cached path set
+        if kwargs.get('path_cache_size', None) is not None:
+            self.path_generator = pathlib.Cached_Path_Generator(self.path_generator, cache_size = kwargs['path_cache_size'])
+
         self.visualize_world_model(screen = False, filename = 'FINAL')
 
     def choose_trajectory(self, t):
@@ -163,15 +220,26 @@ class Robot(object):
         param = None    
         
         max_locs = max_vals = None
-        if self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
-            self.max_val, self.max_locs, self.target = aqlib.sample_max_vals(self.GP, t = t, visualize=True, f_rew=self.f_rew, obstacles = self.obstacle_world)
+        if self.max_val_sampler is not None:
+            self.max_val, self.max_locs, self.target = self.max_val_sampler.sample(self.GP, t = t, visualize = True)
+            if self.f_rew == 'naive' or self.f_rew == 'naive_value':
+                param = ((self.max_val, self.max_locs, self.target), self.sample_radius)
+        elif self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
+            self.max_val, self.max_locs, self.target = aqlib.sample_max_vals(self.GP, t = t, visualize=True, f_rew=self.f_rew, obstacles = self.obstacle_world, n_workers = self.max_val_workers)
         elif self.f_rew == 'naive' or self.f_rew == 'naive_value':
-                self.max_val, self.max_locs, self.target = aqlib.sample_max_vals(self.GP, t=t, obstacles=self.obstacle_world, visualize=True, f_rew=self.f_rew, nK=int(self.sample_num))
+                self.max_val, self.max_locs, self.target = aqlib.sample_max_vals(self.GP, t=t, obstacles=self.obstacle_world, visualize=True, f_rew=self.f_rew, nK=int(self.sample_num), n_workers = self.max_val_workers)
                 param = ((self.max_val, self.max_locs, self.target), self.sample_radius)
         pred_loc, pred_val = self.predict_max(t = t)
             
         paths, true_paths = self.path_generator.get_path_set(self.loc)
 
+        # For additive rewards, score the paths by lookups into a raster of the aquisition function
+        aquisition_function = self.aquisition_function
+        if self.raster_resolution is not None and self.GP.xvals is not None and self.f_rew in ['mean', 'mes', 'naive', 'naive_value']:
+            if self.f_rew == 'mes':
+                param = (self.max_val, self.max_locs, self.target)
+            aquisition_function = aqlib.AcquisitionRaster(self.aquisition_function, t, self.GP, param, resolution = self.raster_resolution)
+
         for path, points in paths.items():
             # set params
             if self.f_rew == 'mes' or self.f_rew == 'maxs-mes':
@@ -197,9 +265,9 @@ class Robot(object):
                 poi = points
 
             if self.use_cost == False:
-                value[path] = self.aquisition_function(time = t, xvals = poi, robot_model = self.GP, param = param)
+                value[path] = aquisition_function(time = t, xvals = poi, robot_model = self.GP, param = param)
             else:
-                reward = self.aquisition_function(time = t, xvals = poi, robot_model = self.GP, param = param)
+                reward = aquisition_function(time = t, xvals = poi, robot_model = self.GP, param = param)
                 value[path] = reward/cost   
         try:
             best_key = np.random.choice([key for key in value.keys() if value[key] == max(value.values())])
@@ -271,8 +339,13 @@ class Robot(object):
             print "Current predicted max and value: \t", pred_loc, "\t", pred_val
             logger.info("Current predicted max and value: {} \t {}".format(pred_loc, pred_val))
 
-            # If myopic planner
-            if self.nonmyopic == False:
+            # If myopic planner, or the mission budget of tree search iterations is spent
+            mcts = None
+            spent = self.mission_budget is not None and self.iterations_used >= self.mission_budget
+            if self.nonmyopic and spent:
+                print "Mission budget of", self.mission_budget, "MCTS iterations spent; planning myopically"
+                logger.info("Mission budget of {} MCTS iterations spent; planning myopically".format(self.mission_budget))
+            if self.nonmyopic == False or spent:
                 sampling_path, best_path, best_val, all_paths, all_values, max_locs = self.choose_trajectory(t = t)
             else:
 
@@ -284,9 +357,32 @@ class Robot(object):
                         param = self.current_max
                     else:
                         param = None
-                # create the tree search
-                mcts = mctslib.cMCTS(self.comp_budget, self.GP, self.loc, self.roll_length, self.path_generator, self.aquisition_function, self.f_rew, t, aq_param = param, use_cost = self.use_cost, tree_type = self.tree_type)
+                # With early termination, the iterations saved at previous steps are available to this one
+                budget = self.comp_budget
+                if self.convergence_confidence is not None and self.planning_deadline is None and self.counts_iterations:
+                    budget += self.budget_bank
+                if self.mission_budget is not None:
+                    budget = min(budget, self.mission_budget - self.iterations_used)
+                min_iterations = min(self.min_iterations, budget)
+
+                # create the tree search, or score all sequences for short horizons
+                if self.tree_type == 'exhaustive':
+                    mcts = mctslib.ExhaustivePlanner(budget, self.GP, self.loc, self.roll_length, self.path_generator, self.aquisition_function, self.f_rew, t, aq_param = param, use_cost = self.use_cost, max_val_sampler = self.max_val_sampler, raster_resolution = self.raster_resolution, collect_stats = self.search_stats, max_val_workers = self.max_val_workers)
+                elif self.tree_type == 'lazy_greedy':
+                    mcts = mctslib.LazyGreedyPlanner(budget, self.GP, self.loc, self.roll_length, self.path_generator, self.aquisition_function, self.f_rew, t, aq_param = param, use_cost = self.use_cost)
+                else:
+                    mcts = mctslib.cMCTS(budget, self.GP, self.loc, self.roll_length, self.path_generator, self.aquisition_function, self.f_rew, t, aq_param = param, use_cost = self.use_cost, tree_type = self.tree_type, max_val_sampler = self.max_val_sampler, raster_resolution = self.raster_resolution, n_workers = self.mcts_workers, batch_size = self.mcts_batch_size, deadline = self.planning_deadline, min_iterations = min_iterations, root = self.mcts_root, memo_budget = self.memo_budget, transposition_resolution = self.transposition_resolution, surrogate_depth = self.surrogate_depth, collect_stats = self.search_stats, convergence_confidence = self.convergence_confidence, value_estimator = self.value_estimator, max_val_workers = self.max_val_workers)
                 sampling_path, best_path, best_val, all_paths, all_values, self.max_locs, self.max_val, self.target = mcts.choose_trajectory(t = t)
+                if self.counts_iterations:
+                    self.iterations_used += mcts.iterations
+                if self.convergence_confidence is not None and self.planning_deadline is None and self.counts_iterations:
+                    self.budget_bank = max(budget - mcts.iterations, 0)
+                    print "MCTS iterations used:", mcts.iterations, "of", budget, "carried over:", self.budget_bank
+                    logger.info("MCTS iterations used: {} of {} carried over: {}".format(mcts.iterations, budget, self.budget_bank))
+
+            if isinstance(self.path_generator, pathlib.Cached_Path_Generator):
+                print "Path cache hits:", self.path_generator.hits, "misses:", self.path_generator.misses
+                logger.info("Path cache hits: {} misses: {}".format(self.path_generator.hits, self.path_generator.misses))
             
             ''' Update eval metrics '''
             # Compute distance traveled
@@ -306,6 +402,8 @@ class Robot(object):
                     max_val = pred_val, 
                     params = [self.current_max, self.current_max_loc, self.max_val, self.max_locs], 
                     dist = self.dist) 
+            if mcts is not None and mcts.stats is not None:
+                self.eval.update_search_stats(t = len(self.trajectory), stats = mcts.stats.as_dict())
 
             if best_path == None:
                 break
@@ -324,6 +422,10 @@ class Robot(object):
             
             self.collect_observations(xlocs)
 
+            # If set, keep the subtree that matches the collected observations for the next step
+            if self.nonmyopic and self.reuse_tree:
+                self.mcts_root = mcts.reroot(self.GP.zvals[-xlocs.shape[0]:]) if mcts is not None else None
+
             # If set, learn the kernel parameters from the new data
             if t < T/3 and self.learn_params == True:
                 self.GP.train_kernel()
@@ -14,25 +14,31 @@ import graphviz
 import os
 
 def import_tree(filename):
-    ''' Return the numpy array of the dictionary object saved to file'''
-    return np.load(filename)
+    ''' Return the tree records saved to file, memory mapped so that fields are only read from disk when used'''
+    return np.load(filename, mmap_mode='r')
 
 def get_trees(filepath):
     ''' Read the directory to get all of the relevant files to transform'''
     trees = {}
     for root, dirs, files in os.walk(filepath):
         for name in files:
-            if 'tree' in name:
-                trees[name.split('_')[1].split('.')[0]]=import_tree(filepath+name).item()
+            if 'tree' in name and name.endswith('.npy'):
+                trees[name.split('_')[1].split('.')[0]]=import_tree(filepath+name)
     return trees
 
+def node_name(tree, node):
+    ''' Re-assemble the name of a node, a sequence of 'child <action>', by following the parents to the root'''
+    actions = []
+    while tree['parent'][node] >= 0:
+        actions.append(tree['action'][node])
+        node = tree['parent'][node]
+    return ' '.join('child ' + str(a) for a in reversed(actions))
+
 def extract_paths(tree):
     ''' Get the last element in a sequence to re-assemble the path'''
     leaves = []
-    for key, value in tree.items():
-        temp = key.count('child')
-        if temp >= 6:
-            leaves.append(key)
+    for node in np.flatnonzero(tree['depth'] >= 6):
+        leaves.append(node_name(tree, node))
     return leaves
 
 def make_tree_graph(leaves):
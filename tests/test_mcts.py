@@ -0,0 +1,33 @@
+''' Checks that the optional search modes of cMCTS compute the same search as the default one '''
+import random
+import unittest
+
+import numpy as np
+
+import aq_library as aqlib
+import gpmodel_library as gplib
+import mcts_library as mctslib
+import paths_library as pathlib
+
+def root_stats(seed, **kwargs):
+    ''' Runs one dpw search from a fixed seed and returns the (nqueries, reward) of the root children '''
+    np.random.seed(seed)
+    random.seed(seed)
+    ranges = (0., 10., 0., 10.)
+    belief = gplib.OnlineGPModel(ranges = ranges, lengthscale = 1.0, variance = 100.0, noise = 0.5)
+    xvals = np.random.uniform(0., 10., size = (20, 2))
+    belief.add_data(xvals, np.random.normal(0., 10., size = (20, 1)))
+    path_generator = pathlib.Dubins_Path_Generator(15, 1.5, 0.05, 0.5, ranges)
+    mcts = mctslib.cMCTS(200, belief, (5.0, 5.0, 0.0), 3, path_generator, aqlib.mean_UCB, 'mean', 0, tree_type = 'dpw', **kwargs)
+    mcts.choose_trajectory(t = 0)
+    return mcts.tree.root.child_stats()
+
+class MemoizedSearchTest(unittest.TestCase):
+    def test_memo_matches_plain_dpw(self):
+        nqueries, reward = root_stats(1)
+        memo_nqueries, memo_reward = root_stats(1, memo_budget = 50e6)
+        np.testing.assert_array_equal(nqueries, memo_nqueries)
+        np.testing.assert_allclose(reward, memo_reward, rtol = 1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
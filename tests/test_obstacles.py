@@ -0,0 +1,40 @@
+''' Checks that the batch obstacle queries agree with in_obstacle '''
+import unittest
+
+import numpy as np
+
+import obstacles as obslib
+
+EXTENT = [0., 10., 0., 10.]
+BUFFERS = [0.0, 0.1, 0.35, 1.0]
+
+def test_points(world, n = 2000):
+	''' Random points over and around the extent, and points on the grown boundaries of the world at every buffer '''
+	points = [np.random.uniform(-1., 11., size = (n, 2))]
+	for buff in BUFFERS:
+		xs, ys = world.boundary_lines(buff)
+		points.append(np.vstack([np.repeat(xs, 20), np.random.uniform(-1., 11., size = 20 * len(xs))]).T)
+		points.append(np.vstack([np.random.uniform(-1., 11., size = 20 * len(ys)), np.repeat(ys, 20)]).T)
+	return np.vstack(points)
+
+class InObstacleBatchTest(unittest.TestCase):
+	def assert_agrees(self, world):
+		points = test_points(world)
+		for buff in BUFFERS:
+			expected = np.array([world.in_obstacle(point, buff) for point in points])
+			np.testing.assert_array_equal(world.in_obstacle_batch(points, buff), expected)
+
+	def test_block_world(self):
+		np.random.seed(0)
+		for num_blocks in [3, 40]:
+			centers = [tuple(center) for center in np.random.uniform(0., 10., size = (num_blocks, 2))]
+			for field_resolution in [None, 0.05, 0.37, 1.0]:
+				self.assert_agrees(obslib.BlockWorld(EXTENT, num_blocks, (1., 1.5), centers, field_resolution = field_resolution))
+
+	def test_channel_world(self):
+		np.random.seed(1)
+		for field_resolution in [None, 0.05, 0.37, 1.0]:
+			self.assert_agrees(obslib.ChannelWorld(EXTENT, (3., 5.), 2., 0.5, field_resolution = field_resolution))
+
+if __name__ == '__main__':
+	unittest.main()